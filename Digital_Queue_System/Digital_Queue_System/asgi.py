@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Digital_Queue_System.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up: live queue updates (SSE and WebSocket)
+# are answered here, everything else goes to Django
+from Token_System.live_updates import QueueEventsRouter  # noqa: E402
+
+application = QueueEventsRouter(django_application)
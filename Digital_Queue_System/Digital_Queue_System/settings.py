@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 import dj_database_url
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -106,6 +107,16 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Take the write lock up front and wait for it, so concurrent
+            # queue joins queue up instead of failing with "database is locked"
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+            # File-backed test database, so multi-threaded tests can share it
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
         }
     }
 
@@ -161,6 +172,8 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# Signature of the appointment reminder emails
+SITE_NAME = 'Digital Queue System'
 
 SITE_ID = 1
 
@@ -189,6 +202,17 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ],
+    # Tokens from /login/, with the token's user cached when CACHE_REDIS_URL
+    # is set (checked against the database on every request otherwise); see
+    # Token_System/authentication.py
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'Token_System.authentication.CachedTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    # Keyset pagination everywhere; see Token_System/pagination.py
+    'DEFAULT_PAGINATION_CLASS': 'Token_System.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
 }
 
 
@@ -197,6 +221,43 @@ CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    # Move yesterday's queue entries out of the live table shortly after midnight
+    'archive-old-queue-entries': {
+        'task': 'Token_System.tasks.archive_old_queue_entries',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    # Send reminders as they fall due; reads only due rows through the
+    # partial remind_at index, so running it every minute is cheap
+    'send-due-reminders': {
+        'task': 'Token_System.tasks.check_upcoming_appointments',
+        'schedule': crontab(),
+    },
+}
+
+# Live queue updates pushed over SSE/WebSockets (see Token_System/events.py).
+# 'memory' only reaches clients of the same worker process; use 'redis' when
+# running more than one ASGI worker.
+QUEUE_EVENTS_BACKEND = os.environ.get('QUEUE_EVENTS_BACKEND', 'memory')
+QUEUE_EVENTS_REDIS_URL = os.environ.get('QUEUE_EVENTS_REDIS_URL', 'redis://localhost:6379/1')
+
+# Cache for the queue list snapshots (Token_System/snapshots.py) and other
+# hot reads. The local-memory cache is per process: set CACHE_REDIS_URL when
+# running several workers so they all see the same versions. API tokens are
+# only cached with a shared cache like this one.
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['CACHE_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 
 # Security settings for production
 # if not DEBUG:
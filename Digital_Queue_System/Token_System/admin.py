@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 # imported models here.
-from .models import Diagnosis, MedicalNote, Treatment, User, Department, Doctor, Patient, Appointment, Queue
+from .models import Diagnosis, MedicalNote, Treatment, User, Department, Doctor, Patient, Appointment, Queue, QueueArchive, QueueServiceStats, QueueTokenSequence
 
 # my Simple admin registration
 admin.site.register(User)
@@ -10,6 +10,9 @@ admin.site.register(Doctor)
 admin.site.register(Patient)
 admin.site.register(Appointment)
 admin.site.register(Queue)
+admin.site.register(QueueTokenSequence)
+admin.site.register(QueueArchive)
+admin.site.register(QueueServiceStats)
 admin.site.register(Treatment)
 admin.site.register(Diagnosis)
 admin.site.register(MedicalNote)
\ No newline at end of file
@@ -0,0 +1,61 @@
+# Token_System/archiving.py
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Queue, QueueArchive, QueueTokenSequence
+
+ARCHIVE_BATCH_SIZE = 1000
+
+ARCHIVED_FIELDS = (
+    'id', 'patient_id', 'scope', 'token_number', 'status', 'queue_date', 'created_at', 'called_at', 'served_at'
+)
+
+
+def archive_old_entries(before=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move queue entries from days before `before` (today by default) into
+    QueueArchive and return how many were moved.
+
+    Works in batches of `batch_size` rows, each in its own short transaction:
+    copy the batch with one bulk INSERT, then remove it with one DELETE ...
+    WHERE id IN (...). Nothing references queue entries and no delete
+    signals listen for them, so Django deletes the batch without first
+    collecting the rows. A
+    big backlog therefore never holds long locks on the live table, and an
+    interrupted run simply continues where it stopped.
+    """
+    before = before or timezone.now().date()
+    old_entries = Queue.objects.filter(queue_date__lt=before).order_by('pk')
+    archived = 0
+
+    while True:
+        with transaction.atomic():
+            rows = list(old_entries.values_list(*ARCHIVED_FIELDS)[:batch_size])
+            if not rows:
+                break
+            QueueArchive.objects.bulk_create(
+                [
+                    QueueArchive(
+                        original_id=entry_id,
+                        patient_id=patient_id,
+                        scope=scope,
+                        token_number=token_number,
+                        status=status,
+                        queue_date=queue_date,
+                        created_at=created_at,
+                        called_at=called_at,
+                        served_at=served_at,
+                    )
+                    for (
+                        entry_id, patient_id, scope, token_number, status, queue_date, created_at, called_at, served_at
+                    ) in rows
+                ],
+                # Another archiver may have copied part of this batch already
+                ignore_conflicts=True,
+            )
+            Queue.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        archived += len(rows)
+
+    # Sequence rows of past days are no longer needed either
+    QueueTokenSequence.objects.filter(day__lt=before).delete()
+    return archived
@@ -0,0 +1,149 @@
+# Token_System/authentication.py
+"""
+Token authentication with the token's user kept in the cache.
+
+DRF's TokenAuthentication looks the token and its user up in the database
+on every request, and the role checks in the views then load the user's
+patient or doctor profile with further queries. CachedTokenAuthentication
+caches, per token, the user's columns (except the password hash) and the
+ids of their patient and doctor profiles for PRINCIPAL_TIMEOUT seconds,
+so an authenticated request needs no query to know who is asking.
+
+The cached user is rebuilt with its password deferred. check_password()
+loads the password when it is needed, and save() writes only the loaded
+columns. Cached principals are stamped with a generation number per user,
+which is bumped once the token is deleted (logout) or the user or one of
+their profiles is saved (password, role or profile changes); signals.py
+does this via forget_token / forget_user_tokens. A principal whose
+generation has moved on is reloaded. The generation is read before the
+user, so a principal loaded just before a change and cached just after it
+carries the old generation and is never used.
+
+Those entries must be seen by every worker: a token revoked through one
+worker would otherwise stay valid on the others until it expires. With a
+process-local cache (the default LocMemCache) every request is therefore
+checked against the database, as plain TokenAuthentication does.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .cache_versions import bump_version, get_version
+from .models import Doctor, Patient, User
+
+PRINCIPAL_TIMEOUT = 60 * 5
+
+# Cache backends whose entries only the process that wrote them sees
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Cached user columns: everything but the password hash
+PRINCIPAL_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+
+
+def cache_is_shared():
+    """Whether all workers use the same cache, so principals may be cached."""
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+def _principal_key(token_key):
+    # Tokens are credentials; keep them out of cache key listings
+    return "auth-token:" + hashlib.sha256(token_key.encode()).hexdigest()
+
+
+def _generation_key(user_id):
+    return f"auth-user:generation:{user_id}"
+
+
+# Left in place of a deleted token's principal, so requests using it are
+# turned away without a query
+REVOKED = 'revoked'
+
+
+def forget_token(token_key, user_id):
+    """After the token is deleted (logout)."""
+    cache.set(_principal_key(token_key), REVOKED, PRINCIPAL_TIMEOUT)
+    # In case a request that read the token before it was deleted caches it
+    # again after the line above
+    forget_user_tokens(user_id)
+
+
+def forget_user_tokens(user_id):
+    """After the user or one of their profiles changes; reloaded on next use."""
+    bump_version(_generation_key(user_id), PRINCIPAL_TIMEOUT)
+
+
+def _principal(user, generation):
+    """What is cached for `user`: their columns and profile ids."""
+    return {
+        'generation': generation,
+        'user_id': user.pk,
+        'user': [getattr(user, name) for name in PRINCIPAL_FIELDS],
+        'patient_id': Patient.objects.filter(user=user).values_list('id', flat=True).first(),
+        'doctor_id': Doctor.objects.filter(user=user).values_list('id', flat=True).first(),
+    }
+
+
+def _profile(model, profile_id, user):
+    # Only the keys are known; other columns load on first access
+    if profile_id is None:
+        return None
+    profile = model.from_db('default', ['id', 'user_id'], [profile_id, user.pk])
+    profile.user = user
+    return profile
+
+
+def _user(principal):
+    """Rebuild the user from a cached principal, profiles included."""
+    user = User.from_db('default', PRINCIPAL_FIELDS, principal['user'])
+    # Read by user.patient_profile / user.doctor_profile without a query;
+    # None makes them raise DoesNotExist as they would after a query
+    User.patient_profile.related.set_cached_value(user, _profile(Patient, principal['patient_id'], user))
+    User.doctor_profile.related.set_cached_value(user, _profile(Doctor, principal['doctor_id'], user))
+    return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication ("Authorization: Token <key>") answering from the
+    cache when it can, if the cache is shared. request.auth is the token key.
+    """
+
+    def authenticate_credentials(self, key):
+        if not cache_is_shared():
+            user, token = super().authenticate_credentials(key)
+            return (user, token.key)
+        principal = cache.get(_principal_key(key))
+        if principal == REVOKED:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if principal is not None:
+            if principal['generation'] != get_version(_generation_key(principal['user_id']), PRINCIPAL_TIMEOUT):
+                principal = None
+        if principal is None:
+            principal = self._load_principal(key)
+            # Replaces an outdated principal; one cached by a request that
+            # raced with a change carries the old generation
+            cache.set(_principal_key(key), principal, PRINCIPAL_TIMEOUT)
+
+        user = _user(principal)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (user, key)
+
+    def _load_principal(self, key):
+        # The token's user never changes, but the token may be deleted
+        # before the generation is read: look it up again afterwards
+        user_id = Token.objects.filter(key=key).values_list('user_id', flat=True).first()
+        if user_id is not None:
+            generation = get_version(_generation_key(user_id), PRINCIPAL_TIMEOUT)
+            token = Token.objects.select_related('user').filter(key=key).first()
+            if token is not None:
+                return _principal(token.user, generation)
+        raise exceptions.AuthenticationFailed(_('Invalid token.'))
@@ -0,0 +1,167 @@
+"""
+Throughput benchmarks for the queue hot paths.
+
+They are not part of the regular test run; run them explicitly with
+
+    python manage.py test Token_System.benchmarks
+"""
+import threading
+import time
+from datetime import date, timedelta
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from .models import Appointment, Department, Doctor, Patient, Queue, QueueTokenSequence
+from .queueing import claim_next, people_ahead
+from .serializers import AppointmentReadSerializer, AppointmentSerializer
+
+
+# ------------------------
+# call_next Benchmark
+# ------------------------
+class CallNextBenchmark(TransactionTestCase):
+    waiting = 1000
+    counter_counts = (1, 4, 16)
+
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            name="Benchmark Patient",
+            email="benchmark@example.com",
+            date_of_birth=date(1990, 1, 1),
+        )
+
+    def fill_queue(self):
+        Queue.objects.all().delete()
+        Queue.objects.bulk_create(
+            Queue(patient=self.patient, token_number=token)
+            for token in range(1, self.waiting + 1)
+        )
+
+    def run_counters(self, counters):
+        called = []
+
+        def counter():
+            try:
+                while claim_next() is not None:
+                    called.append(1)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=counter) for _ in range(counters)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return len(called), time.perf_counter() - started
+
+    def test_call_next_throughput(self):
+        print(f"\ncall_next on {connection.vendor}, {self.waiting} waiting tokens")
+        for counters in self.counter_counts:
+            self.fill_queue()
+            calls, elapsed = self.run_counters(counters)
+            self.assertEqual(calls, self.waiting)
+            print(f"  {counters:>2} counters: {calls / elapsed:8.0f} calls/sec")
+
+
+# ------------------------
+# position Benchmark
+# ------------------------
+class PositionBenchmark(TestCase):
+    sizes = (100, 10_000, 100_000)
+    lookups = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = Patient.objects.create(
+            name="Benchmark Patient",
+            email="benchmark@example.com",
+            date_of_birth=date(1990, 1, 1),
+        )
+
+    def fill_queue(self, waiting):
+        today = timezone.now().date()
+        Queue.objects.all().delete()
+        QueueTokenSequence.objects.all().delete()
+        Queue.objects.bulk_create(
+            (Queue(patient=self.patient, token_number=token, queue_date=today)
+             for token in range(1, waiting + 1)),
+            batch_size=5000,
+        )
+        QueueTokenSequence.objects.create(day=today, last_token=waiting)
+        return Queue.objects.get(token_number=waiting)
+
+    def time_per_lookup(self, lookup, entry):
+        started = time.perf_counter()
+        for _ in range(self.lookups):
+            lookup(entry)
+        return (time.perf_counter() - started) / self.lookups * 1_000_000
+
+    @staticmethod
+    def counted(entry):
+        return Queue.objects.filter(
+            queue_date=entry.queue_date,
+            status='waiting',
+            token_number__lt=entry.token_number
+        ).count()
+
+    def test_count_vs_watermark(self):
+        print(f"\nposition of the last waiting token on {connection.vendor} (microseconds per lookup)")
+        print(f"  {'waiting':>8}  {'COUNT(*)':>10}  {'watermark':>10}")
+        for waiting in self.sizes:
+            entry = self.fill_queue(waiting)
+            self.assertEqual(self.counted(entry), people_ahead(entry))
+            counted = self.time_per_lookup(self.counted, entry)
+            watermark = self.time_per_lookup(people_ahead, entry)
+            print(f"  {waiting:>8}  {counted:>10.0f}  {watermark:>10.0f}")
+
+
+# ------------------------
+# Appointment List Serialization Benchmark
+# ------------------------
+class AppointmentSerializationBenchmark(TestCase):
+    appointments = 10_000
+    rounds = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        patient = Patient.objects.create(
+            name="Benchmark Patient",
+            email="benchmark@example.com",
+            date_of_birth=date(1990, 1, 1),
+        )
+        doctor = Doctor.objects.create(
+            name="Benchmark Doctor", specialty="GP", department=Department.objects.create(name="Benchmark")
+        )
+        start = timezone.now()
+        Appointment.objects.bulk_create(
+            (Appointment(patient=patient, doctor=doctor, date=start + timedelta(minutes=minute))
+             for minute in range(cls.appointments)),
+            batch_size=5000,
+        )
+
+    def best_of(self, serialize):
+        timings = []
+        for _ in range(self.rounds):
+            started = time.perf_counter()
+            data = serialize()
+            timings.append(time.perf_counter() - started)
+        self.assertEqual(len(data), self.appointments)
+        return min(timings)
+
+    def test_model_serializer_vs_values(self):
+        appointments = Appointment.objects.order_by('-date', '-id')
+        self.assertEqual(
+            AppointmentReadSerializer.to_representation(AppointmentReadSerializer.values(appointments[:50])),
+            AppointmentSerializer(appointments[:50], many=True).data,
+        )
+
+        model = self.best_of(lambda: AppointmentSerializer(appointments.all(), many=True).data)
+        fast = self.best_of(
+            lambda: AppointmentReadSerializer.to_representation(AppointmentReadSerializer.values(appointments.all()))
+        )
+        print(f"\nserializing {self.appointments} appointments on {connection.vendor} (query included)")
+        print(f"  ModelSerializer:      {self.appointments / model:8.0f} rows/sec")
+        print(f"  ValuesReadSerializer: {self.appointments / fast:8.0f} rows/sec ({model / fast:.1f}x)")
@@ -0,0 +1,35 @@
+# Token_System/cache_versions.py
+"""
+Version numbers kept in the shared cache.
+
+Cached data (queue snapshots, medical histories, reference tables) is
+stored or checked under a version number that writers bump once their
+change commits. A reader takes the version before querying the database,
+so data built from rows that changed meanwhile ends up under a version
+that has already been replaced and is never served.
+
+A version that is missing, e.g. after an eviction, starts again from the
+clock rather than from 1, so it never comes back with a number older data
+was stored under.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def get_version(key, timeout):
+    """Current version stored under `key`, starting one if there is none."""
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, timeout):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key, timeout):
+    """Replace the version under `key`, so data stored under the old one is never read."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout)
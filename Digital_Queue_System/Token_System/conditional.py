@@ -0,0 +1,68 @@
+# Token_System/conditional.py
+"""
+Conditional requests for medical records, validated by `updated_at`.
+
+Exam-room tablets refresh records constantly, while a record rarely
+changes between two refreshes. Every record response carries an ETag and
+Last-Modified derived from `updated_at`; a GET sending them back in
+If-None-Match / If-Modified-Since is answered with 304 after reading that
+one column. Updates sending If-Match are rejected with 412 when the record
+has changed since the client read it, instead of overwriting the change.
+
+The ETag also names the representation (?fields= / ?expand=), so a copy of
+a sparse response never validates a request for the full record. If-Match
+compares the record version only, whichever representation it came from.
+"""
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .sparse_fields import requested_expansions, requested_fields
+
+
+def representation(request):
+    """The normalized ?fields= / ?expand= of `request`; '' for the full record."""
+    parts = []
+    fields = requested_fields(request)
+    if fields is not None:
+        parts.append("fields=" + ",".join(sorted(fields)))
+    expand = requested_expansions(request)
+    if expand:
+        parts.append("expand=" + ",".join(sorted(expand)))
+    return "&".join(parts)
+
+
+def _version(pk, updated_at):
+    return f"medical-record-{pk}-{int(updated_at.timestamp() * 1_000_000)}"
+
+
+def record_etag(pk, updated_at, variant=''):
+    version = _version(pk, updated_at)
+    return quote_etag(f"{version};{variant}" if variant else version)
+
+
+def validator_headers(pk, updated_at, variant=''):
+    """ETag and Last-Modified headers for a record last saved at `updated_at`."""
+    return {
+        'ETag': record_etag(pk, updated_at, variant),
+        'Last-Modified': http_date(updated_at.timestamp()),
+        'Cache-Control': 'private, no-cache',
+    }
+
+
+def is_not_modified(request, pk, updated_at, variant=''):
+    """Whether the client's copy (If-None-Match / If-Modified-Since) is current."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or record_etag(pk, updated_at, variant) in etags
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(updated_at.timestamp()) <= since
+
+
+def fails_if_match(request, pk, updated_at):
+    """Whether the request has an If-Match the current record does not satisfy."""
+    if_match = request.headers.get('If-Match')
+    if not if_match:
+        return False
+    etags = parse_etags(if_match)
+    version = _version(pk, updated_at)
+    return '*' not in etags and not any(etag.strip('"').split(';')[0] == version for etag in etags)
@@ -0,0 +1,220 @@
+# Token_System/events.py
+"""
+Publish/subscribe for live queue updates.
+
+Views publish an event whenever a token joins, is called, served, skipped or
+the queue is reset; the ASGI endpoints in live_updates.py forward them to
+subscribed display screens and phones. Two backends are available, picked
+with the QUEUE_EVENTS_BACKEND setting:
+
+- 'memory' (default): subscribers in the same process only. Fine for a
+  single ASGI worker and for development.
+- 'redis': Redis PUBLISH/SUBSCRIBE, so events reach subscribers connected
+  to any worker. Each worker holds one subscriber connection, however many
+  clients it serves.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .snapshots import invalidate_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def channel_name(scope):
+    return f"queue:{scope}"
+
+
+# ------------------------
+# In-memory backend
+# ------------------------
+class InMemorySubscription:
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.loop = None
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.broker._add(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.broker._remove(self)
+
+    def deliver(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A subscriber that stopped reading must not hold up everyone else
+            pass
+
+    async def get(self, timeout=None):
+        """Next message, or None if nothing arrived within `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InMemoryBroker:
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscriptions[subscription.channel].add(subscription)
+
+    def _remove(self, subscription):
+        with self._lock:
+            self._subscriptions[subscription.channel].discard(subscription)
+
+    def publish(self, channel, message):
+        # Called from request threads; hand the message to each subscriber's
+        # own event loop rather than touching its queue directly
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+
+    def subscribe(self, channel):
+        return InMemorySubscription(self, channel, self.max_pending)
+
+
+# ------------------------
+# Redis backend
+# ------------------------
+class RedisSubscription(InMemorySubscription):
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        await self.broker._join(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.broker._leave(self)
+
+
+class RedisBroker:
+    """
+    Publishes with Redis PUBLISH. Subscribers of this process share one
+    Redis pub/sub connection: it is subscribed to every channel somebody
+    here listens on, and one reader task hands each message to the local
+    subscribers of its channel.
+    """
+
+    def __init__(self, url, max_pending=100):
+        import redis
+
+        self.url = url
+        self.max_pending = max_pending
+        self.client = redis.Redis.from_url(url)
+        self._subscriptions = defaultdict(set)
+        self._pubsub = None
+        self._reader = None
+        self._lock = None
+
+    def _connect(self):
+        import redis.asyncio as aioredis
+
+        return aioredis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+
+    async def _join(self, subscription):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._pubsub is None:
+                self._pubsub = self._connect()
+            channel = subscription.channel
+            if not self._subscriptions[channel]:
+                await self._pubsub.subscribe(channel)
+            self._subscriptions[channel].add(subscription)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+
+    async def _leave(self, subscription):
+        async with self._lock:
+            channel = subscription.channel
+            self._subscriptions[channel].discard(subscription)
+            if not self._subscriptions[channel]:
+                del self._subscriptions[channel]
+                await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while self._subscriptions:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The connection resubscribes when it reconnects
+                logger.exception("Lost the queue events subscription; retrying")
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message['channel']
+            channel = channel.decode() if isinstance(channel, bytes) else channel
+            for subscription in list(self._subscriptions.get(channel, ())):
+                subscription.deliver(message['data'].decode())
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel):
+        return RedisSubscription(self, channel, self.max_pending)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                backend = getattr(settings, 'QUEUE_EVENTS_BACKEND', 'memory')
+                if backend == 'redis':
+                    _broker = RedisBroker(settings.QUEUE_EVENTS_REDIS_URL)
+                else:
+                    _broker = InMemoryBroker()
+    return _broker
+
+
+def _send(channel, message):
+    try:
+        get_broker().publish(channel, message)
+    except Exception:
+        # Live updates are best effort; the queue change itself has been saved
+        logger.exception("Could not publish queue event on %s", channel)
+
+
+def publish_queue_event(scope, event, entry=None):
+    """
+    Broadcast `event` for the queue `scope` once the current transaction
+    commits, so subscribers never hear about changes that were rolled back.
+    The cached list snapshot of the queue is expired at the same time.
+    """
+    day = entry.queue_date if entry is not None else None
+    transaction.on_commit(lambda: invalidate_snapshot(scope, day))
+
+    payload = {'event': event, 'scope': scope}
+    if entry is not None:
+        payload.update({
+            'id': entry.id,
+            'token_number': entry.token_number,
+            'status': entry.status,
+            'queue_date': entry.queue_date,
+        })
+    message = json.dumps(payload, cls=DjangoJSONEncoder)
+    transaction.on_commit(lambda: _send(channel_name(scope), message))
@@ -0,0 +1,77 @@
+# Token_System/exports.py
+"""
+Record sets that can be exported in bulk (appointments and the medical
+history attached to them), with the date range and department filters
+shared by the export endpoints and the export_records command.
+"""
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+
+from django.db import models
+from django.utils import timezone
+
+from .models import Appointment, Diagnosis, MedicalNote, Treatment
+from .serializers import (
+    AppointmentReadSerializer, DiagnosisReadSerializer, MedicalNoteReadSerializer, TreatmentReadSerializer
+)
+
+ExportSpec = namedtuple('ExportSpec', ['model', 'read_serializer', 'date_field', 'department_field'])
+
+EXPORTS = {
+    'appointments': ExportSpec(Appointment, AppointmentReadSerializer, 'date', 'doctor__department'),
+    'treatments': ExportSpec(Treatment, TreatmentReadSerializer, 'start_date', 'appointment__doctor__department'),
+    'diagnoses': ExportSpec(Diagnosis, DiagnosisReadSerializer, 'diagnosed_date', 'appointment__doctor__department'),
+    'notes': ExportSpec(MedicalNote, MedicalNoteReadSerializer, 'created_at', 'appointment__doctor__department'),
+}
+
+
+def parse_export_filters(params):
+    """
+    date_from / date_to (YYYY-MM-DD, inclusive) and department_id from
+    request query parameters. Raises ValueError for malformed values.
+    """
+    filters = {}
+    for name in ('date_from', 'date_to'):
+        if params.get(name):
+            try:
+                filters[name] = date.fromisoformat(params[name])
+            except ValueError:
+                raise ValueError(f"{name} must be a date (YYYY-MM-DD).")
+    if params.get('department_id'):
+        try:
+            filters['department_id'] = int(params['department_id'])
+        except ValueError:
+            raise ValueError("department_id must be an integer.")
+    return filters
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_export(queryset, name, date_from=None, date_to=None, department_id=None):
+    """
+    Narrow `queryset` of the `name` export to a date range and department.
+    Date ranges on datetime columns are turned into [start, end) bounds so
+    the column's index can be used.
+    """
+    spec = EXPORTS[name]
+    is_datetime = isinstance(queryset.model._meta.get_field(spec.date_field), models.DateTimeField)
+    if date_from:
+        bound = _day_start(date_from) if is_datetime else date_from
+        queryset = queryset.filter(**{f"{spec.date_field}__gte": bound})
+    if date_to:
+        if is_datetime:
+            queryset = queryset.filter(**{f"{spec.date_field}__lt": _day_start(date_to + timedelta(days=1))})
+        else:
+            queryset = queryset.filter(**{f"{spec.date_field}__lte": date_to})
+    if department_id:
+        queryset = queryset.filter(**{f"{spec.department_field}_id": department_id})
+    return queryset
+
+
+def export_queryset(name, **filters):
+    """All rows of the `name` export matching `filters`, oldest first."""
+    spec = EXPORTS[name]
+    queryset = spec.model.objects.order_by(spec.date_field, 'pk')
+    return filter_export(queryset, name, **filters)
@@ -0,0 +1,59 @@
+# Token_System/history_cache.py
+"""
+Cached, versioned copy of a patient's medical history for
+GET /api/patients/<id>/medical-history/.
+
+Doctors open the same chart many times during a visit, while it only
+changes when one of the patient's appointments, treatments, diagnoses,
+notes or their medical record is saved or deleted. The assembled history
+is therefore cached under a version number per patient, which the signals
+in signals.py bump once the change commits, plus a shared version for
+doctors, whose names the history shows.
+
+The versions are bumped by whichever process saves the change, so the
+view only uses this cache when it is shared by every process (see
+authentication.cache_is_shared).
+"""
+from django.core.cache import cache
+
+from .cache_versions import bump_version, get_version
+
+HISTORY_TIMEOUT = 60 * 60 * 24
+
+DOCTORS_VERSION_KEY = "medical-history:version:doctors"
+
+
+def _patient_key(patient_id):
+    return f"medical-history:version:patient:{patient_id}"
+
+
+def history_version(patient_id):
+    """Current version of the patient's history (including doctor names)."""
+    return (
+        f"{get_version(_patient_key(patient_id), HISTORY_TIMEOUT)}-"
+        f"{get_version(DOCTORS_VERSION_KEY, HISTORY_TIMEOUT)}"
+    )
+
+
+def get_history(patient_id, version, build):
+    """
+    The patient's history at `version`, calling `build()` to assemble it
+    from the database when it is not cached yet.
+    """
+    key = f"medical-history:data:{patient_id}:{version}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, HISTORY_TIMEOUT)
+    return data
+
+
+def invalidate_history(*patient_ids):
+    for patient_id in set(patient_ids):
+        if patient_id is not None:
+            bump_version(_patient_key(patient_id), HISTORY_TIMEOUT)
+
+
+def invalidate_doctor_names():
+    """Every cached history, after a doctor is renamed or removed."""
+    bump_version(DOCTORS_VERSION_KEY, HISTORY_TIMEOUT)
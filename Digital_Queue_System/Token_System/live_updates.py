@@ -0,0 +1,161 @@
+# Token_System/live_updates.py
+"""
+ASGI endpoints that push queue events to clients instead of making them poll:
+
+- GET /api/queues/events/?scope=global   Server-Sent Events stream
+- ws://.../ws/queues/?scope=global        WebSocket, one JSON text frame per event
+
+Both need the token from /api/auth/login/, sent as "Authorization: Token
+<key>" or, since browsers cannot set headers on EventSource and WebSocket
+connections, as a `token` query parameter. Every other request is passed
+through to the Django application.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from rest_framework import exceptions
+
+from .authentication import CachedTokenAuthentication
+from .events import channel_name, get_broker
+
+SSE_PATH = '/api/queues/events/'
+WEBSOCKET_PATH = '/ws/queues/'
+# Send something at least this often so proxies don't drop idle connections
+KEEPALIVE_SECONDS = 15
+
+
+def _query(scope):
+    return parse_qs(scope.get('query_string', b'').decode())
+
+
+def _queue_scope(scope):
+    return _query(scope).get('scope', ['global'])[0]
+
+
+def _token_key(scope):
+    """Token key from the Authorization header or the `token` parameter."""
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            keyword, _, key = value.decode('latin-1').partition(' ')
+            if keyword == 'Token' and key.strip():
+                return key.strip()
+    return _query(scope).get('token', [None])[0]
+
+
+def authenticate_token(key):
+    """The active user owning token `key`, or None."""
+    try:
+        return CachedTokenAuthentication().authenticate_credentials(key)[0]
+    except exceptions.AuthenticationFailed:
+        return None
+
+
+async def _authenticated_user(scope):
+    key = _token_key(scope)
+    if not key:
+        return None
+    return await sync_to_async(authenticate_token)(key)
+
+
+async def _wait_for_disconnect(receive, disconnect_type, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == disconnect_type:
+            disconnected.set()
+            return
+
+
+async def _next_message(subscription, disconnected):
+    """
+    Wait for the next event; None if the keepalive interval passed or the
+    client went away first.
+    """
+    getter = asyncio.ensure_future(subscription.get(timeout=KEEPALIVE_SECONDS))
+    watcher = asyncio.ensure_future(disconnected.wait())
+    done, pending = await asyncio.wait({getter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    return getter.result() if getter in done else None
+
+
+async def server_sent_events(scope, receive, send):
+    if scope['method'] != 'GET':
+        await send({'type': 'http.response.start', 'status': 405, 'headers': [(b'allow', b'GET')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if await _authenticated_user(scope) is None:
+        body = json.dumps({'detail': "Authentication credentials were not provided or are invalid."}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 401,
+            'headers': [(b'content-type', b'application/json'), (b'www-authenticate', b'Token')],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        return
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_wait_for_disconnect(receive, 'http.disconnect', disconnected))
+    try:
+        async with get_broker().subscribe(channel_name(_queue_scope(scope))) as subscription:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no'),
+                ],
+            })
+            await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+            while True:
+                message = await _next_message(subscription, disconnected)
+                if disconnected.is_set():
+                    break
+                chunk = f"data: {message}\n\n" if message is not None else ": keepalive\n\n"
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    finally:
+        watcher.cancel()
+
+
+async def websocket_events(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if await _authenticated_user(scope) is None:
+        # Closing before accepting rejects the handshake
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+    await send({'type': 'websocket.accept'})
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_wait_for_disconnect(receive, 'websocket.disconnect', disconnected))
+    try:
+        async with get_broker().subscribe(channel_name(_queue_scope(scope))) as subscription:
+            while True:
+                message = await _next_message(subscription, disconnected)
+                if disconnected.is_set():
+                    break
+                if message is not None:
+                    await send({'type': 'websocket.send', 'text': message})
+    finally:
+        watcher.cancel()
+
+
+class QueueEventsRouter:
+    """Serve the live update endpoints and hand everything else to `app`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == SSE_PATH:
+            return await server_sent_events(scope, receive, send)
+        if scope['type'] == 'websocket':
+            if scope['path'] == WEBSOCKET_PATH:
+                return await websocket_events(scope, receive, send)
+            # Django does not handle WebSockets itself
+            await send({'type': 'websocket.close', 'code': 4404})
+            return
+        return await self.app(scope, receive, send)
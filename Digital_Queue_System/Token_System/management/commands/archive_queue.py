@@ -0,0 +1,23 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from Token_System.archiving import ARCHIVE_BATCH_SIZE, archive_old_entries
+
+
+class Command(BaseCommand):
+    help = "Move queue entries from previous days into the queue archive, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+            help=f"Rows moved per transaction (default {ARCHIVE_BATCH_SIZE}).",
+        )
+        parser.add_argument(
+            '--before', type=date.fromisoformat, default=None,
+            help="Archive entries from days before this date (YYYY-MM-DD). Defaults to today.",
+        )
+
+    def handle(self, *args, **options):
+        archived = archive_old_entries(before=options['before'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} queue entries."))
@@ -0,0 +1,52 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from Token_System.exports import EXPORTS, export_queryset
+from Token_System.streaming import OUTPUT_FORMATS, STREAM_CHUNK_SIZE, stream_export
+
+
+class Command(BaseCommand):
+    help = "Stream appointments, treatments, diagnoses or notes to a CSV, NDJSON or JSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('records', choices=sorted(EXPORTS), help="Which records to export.")
+        parser.add_argument(
+            '--output', choices=sorted(OUTPUT_FORMATS), default='csv', help="File format (default csv).",
+        )
+        parser.add_argument(
+            '--from', dest='date_from', type=date.fromisoformat, default=None,
+            help="Only records on or after this date (YYYY-MM-DD).",
+        )
+        parser.add_argument(
+            '--to', dest='date_to', type=date.fromisoformat, default=None,
+            help="Only records on or before this date (YYYY-MM-DD).",
+        )
+        parser.add_argument(
+            '--department', dest='department_id', type=int, default=None,
+            help="Only records of this department id.",
+        )
+        parser.add_argument('--file', default=None, help="Write here instead of to standard output.")
+        parser.add_argument(
+            '--chunk-size', type=int, default=STREAM_CHUNK_SIZE,
+            help=f"Rows fetched and written per step (default {STREAM_CHUNK_SIZE}).",
+        )
+
+    def handle(self, *args, **options):
+        name = options['records']
+        queryset = export_queryset(
+            name,
+            date_from=options['date_from'],
+            date_to=options['date_to'],
+            department_id=options['department_id'],
+        )
+        chunks = stream_export(queryset, EXPORTS[name].read_serializer, options['output'], options['chunk_size'])
+
+        if options['file']:
+            with open(options['file'], 'wb') as target:
+                for chunk in chunks:
+                    target.write(chunk)
+            self.stderr.write(self.style.SUCCESS(f"Exported {name} to {options['file']}."))
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
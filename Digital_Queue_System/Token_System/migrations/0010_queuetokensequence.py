@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0009_diagnosis_medicalnote_treatment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueTokenSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('scope', models.CharField(default='global', max_length=50)),
+                ('last_token', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'scope'), name='unique_token_sequence_per_day')],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:30
+
+import Token_System.models
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+from django.db.models.functions import TruncDate
+
+
+def copy_flags_to_status(apps, schema_editor):
+    """Derive status and queue_date for existing entries from the old flags."""
+    Queue = apps.get_model('Token_System', 'Queue')
+    Queue.objects.update(
+        queue_date=TruncDate('created_at'),
+        status=Case(
+            When(is_served=True, then=Value('served')),
+            When(is_called=True, then=Value('called')),
+            default=Value('waiting'),
+        ),
+    )
+
+
+def copy_status_to_flags(apps, schema_editor):
+    Queue = apps.get_model('Token_System', 'Queue')
+    Queue.objects.update(
+        is_called=Case(When(status='waiting', then=Value(False)), default=Value(True)),
+        is_served=Case(When(status='served', then=Value(True)), default=Value(False)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0010_queuetokensequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='queue_date',
+            field=models.DateField(default=Token_System.models.queue_day),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('called', 'Called'), ('served', 'Served'), ('skipped', 'Skipped'), ('no_show', 'No Show')], default='waiting', max_length=20),
+        ),
+        migrations.RunPython(copy_flags_to_status, copy_status_to_flags),
+        migrations.RemoveField(
+            model_name='queue',
+            name='is_called',
+        ),
+        migrations.RemoveField(
+            model_name='queue',
+            name='is_served',
+        ),
+        migrations.AddIndex(
+            model_name='queue',
+            index=models.Index(fields=['queue_date', 'status', 'token_number'], name='queue_day_status_token'),
+        ),
+        migrations.AddIndex(
+            model_name='queue',
+            index=models.Index(condition=models.Q(('status', 'waiting')), fields=['queue_date', 'token_number'], name='queue_waiting_by_token'),
+        ),
+    ]
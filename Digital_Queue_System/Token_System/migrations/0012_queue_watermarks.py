@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+def seed_watermarks(apps, schema_editor):
+    """Fill the new watermark columns of existing sequence rows from their entries."""
+    Queue = apps.get_model('Token_System', 'Queue')
+    QueueTokenSequence = apps.get_model('Token_System', 'QueueTokenSequence')
+    for sequence in QueueTokenSequence.objects.all():
+        waiting = set(
+            Queue.objects.filter(queue_date=sequence.day, status='waiting')
+            .values_list('token_number', flat=True)
+        )
+        called_through = min(waiting) - 1 if waiting else sequence.last_token
+        sequence.called_through = called_through
+        sequence.departed_ahead = [
+            token for token in range(called_through + 1, sequence.last_token + 1) if token not in waiting
+        ]
+        sequence.save(update_fields=['called_through', 'departed_ahead'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0011_queue_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuetokensequence',
+            name='called_through',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='queuetokensequence',
+            name='departed_ahead',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(seed_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0012_queue_watermarks'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='queue',
+            name='queue_day_status_token',
+        ),
+        migrations.RemoveIndex(
+            model_name='queue',
+            name='queue_waiting_by_token',
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='department',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='queue_entries', to='Token_System.department'),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='doctor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='queue_entries', to='Token_System.doctor'),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='scope',
+            field=models.CharField(default='global', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='queue',
+            index=models.Index(fields=['scope', 'queue_date', 'status', 'token_number'], name='queue_scope_day_status_token'),
+        ),
+        migrations.AddIndex(
+            model_name='queue',
+            index=models.Index(condition=models.Q(('status', 'waiting')), fields=['scope', 'queue_date', 'token_number'], name='queue_scope_waiting_by_token'),
+        ),
+    ]
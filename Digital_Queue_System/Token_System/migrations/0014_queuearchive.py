@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0013_queue_scopes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField(unique=True)),
+                ('patient_id', models.BigIntegerField()),
+                ('scope', models.CharField(max_length=50)),
+                ('token_number', models.IntegerField()),
+                ('status', models.CharField(max_length=20)),
+                ('queue_date', models.DateField(db_index=True)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0014_queuearchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueServiceStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50, unique=True)),
+                ('avg_service_seconds', models.FloatField(default=0)),
+                ('served_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'queue service stats',
+            },
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='called_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queue',
+            name='served_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queuearchive',
+            name='called_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queuearchive',
+            name='served_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0015_queue_service_times'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['date', 'id'], name='appointment_date_id'),
+        ),
+    ]
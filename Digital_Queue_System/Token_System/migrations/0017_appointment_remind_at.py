@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:07
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_remind_at(apps, schema_editor):
+    """Reminder times of existing scheduled appointments (24 hours ahead)."""
+    Appointment = apps.get_model('Token_System', 'Appointment')
+    Appointment.objects.filter(status='scheduled').update(remind_at=F('date') - timedelta(hours=24))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Token_System', '0016_appointment_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='remind_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(condition=models.Q(('reminder_sent', False)), fields=['remind_at'], name='appointment_remind_at'),
+        ),
+        migrations.RunPython(fill_remind_at, migrations.RunPython.noop),
+    ]
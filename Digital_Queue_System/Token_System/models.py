@@ -1,4 +1,7 @@
+from datetime import timedelta
+
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 from django.contrib.auth.models import AbstractUser
@@ -16,8 +19,41 @@ class User(AbstractUser):
     role = models.CharField(max_length=20, choices=ROLES, default='staff')
     date_of_birth = models.DateField(null=True, blank=True)
 
+    # Fields whose changes are copied to the patient profile (see signals.py)
+    TRACKED_FIELDS = ('username', 'email', 'date_of_birth', 'role')
+
     def __str__(self):
         return f"{self.username} ({self.role})"
+
+    def _tracked_values(self):
+        # From __dict__, so deferred fields are skipped rather than loaded
+        return {name: self.__dict__[name] for name in self.TRACKED_FIELDS if name in self.__dict__}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_values = instance._tracked_values()
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        saved = self._tracked_values()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            # Other fields were not written and keep their last saved values
+            saved = {**getattr(self, '_saved_values', {}), **{
+                name: value for name, value in saved.items() if name in update_fields
+            }}
+        self._saved_values = saved
+
+    def changed_fields(self):
+        """
+        TRACKED_FIELDS that differ from the values last loaded from or
+        saved to the database; all of them for a user never saved.
+        """
+        saved = getattr(self, '_saved_values', {})
+        current = self._tracked_values()
+        return [name for name in current if name not in saved or saved[name] != current[name]]
     
 # ------------------------
 # Department
@@ -72,19 +108,149 @@ class Patient(models.Model):
 # ------------------------
 # Queue / Token System
 # ------------------------
+def queue_day():
+    """The day a new queue entry belongs to."""
+    return timezone.now().date()
+
+
 class Queue(models.Model):
+    STATUS_CHOICES = (
+        ('waiting', 'Waiting'),
+        ('called', 'Called'),
+        ('served', 'Served'),
+        ('skipped', 'Skipped'),
+        ('no_show', 'No Show'),
+    )
+    # Which statuses an entry may move to from its current status
+    TRANSITIONS = {
+        'waiting': ('called', 'served', 'skipped', 'no_show'),
+        'called': ('served', 'skipped', 'no_show'),
+        'served': (),
+        'skipped': (),
+        'no_show': (),
+    }
+
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="queue_entries")
+    # Which queue the token belongs to: a doctor's, a department's or the
+    # global one. `scope` is the partition key derived from them
+    # ("doctor:<id>", "department:<id>" or "global"); tokens are numbered,
+    # called and positioned within it.
+    department = models.ForeignKey(
+        Department, on_delete=models.CASCADE, null=True, blank=True, related_name="queue_entries"
+    )
+    doctor = models.ForeignKey(
+        Doctor, on_delete=models.CASCADE, null=True, blank=True, related_name="queue_entries"
+    )
+    scope = models.CharField(max_length=50, default='global')
     token_number = models.IntegerField()
-    is_called = models.BooleanField(default=False)
-    is_served = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='waiting')
+    queue_date = models.DateField(default=queue_day)
     created_at = models.DateTimeField(auto_now_add=True)
+    called_at = models.DateTimeField(null=True, blank=True)
+    served_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['token_number']
+        indexes = [
+            # A scope's entries for a day in a given state, in token order
+            models.Index(fields=['scope', 'queue_date', 'status', 'token_number'], name='queue_scope_day_status_token'),
+            # Only the waiting entries: keeps call_next and position small
+            # however much history accumulates
+            models.Index(
+                fields=['scope', 'queue_date', 'token_number'],
+                condition=models.Q(status='waiting'),
+                name='queue_scope_waiting_by_token',
+            ),
+        ]
 
     def __str__(self):
         return f"Token {self.token_number} - {self.patient.name}"
-    
+
+    @property
+    def is_called(self):
+        return self.status != 'waiting'
+
+    @property
+    def is_served(self):
+        return self.status == 'served'
+
+    def can_transition_to(self, status):
+        return status in self.TRANSITIONS[self.status]
+
+
+# ------------------------
+# Daily Token Sequence
+# ------------------------
+class QueueTokenSequence(models.Model):
+    """
+    One counter row per day and queue scope. Tokens are handed out by
+    incrementing last_token atomically, so joins never scan the Queue table.
+
+    The row also tracks which tokens have left the waiting line, so a
+    token's position is computed without counting rows: every token up to
+    called_through has left, and departed_ahead lists (sorted) the tokens
+    above it that left out of order, e.g. skipped while earlier tokens wait.
+    """
+    day = models.DateField()
+    scope = models.CharField(max_length=50, default='global')
+    last_token = models.PositiveIntegerField(default=0)
+    called_through = models.PositiveIntegerField(default=0)
+    departed_ahead = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'scope'], name='unique_token_sequence_per_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.day}: {self.last_token}"
+
+
+# ------------------------
+# Service Time Statistics
+# ------------------------
+class QueueServiceStats(models.Model):
+    """
+    Rolling service time of one queue scope, kept as an exponentially
+    weighted moving average that is updated each time a token is served.
+    Estimating a wait is then a single row read, however much history
+    the queue has.
+    """
+    scope = models.CharField(max_length=50, unique=True)
+    avg_service_seconds = models.FloatField(default=0)
+    served_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "queue service stats"
+
+    def __str__(self):
+        return f"{self.scope}: {self.avg_service_seconds:.0f}s over {self.served_count} served"
+
+
+# ------------------------
+# Queue Archive
+# ------------------------
+class QueueArchive(models.Model):
+    """
+    Compact copy of a queue entry from a previous day. Old entries are moved
+    here in batches so the live Queue table only holds today's tokens.
+    References are plain ids, so archived rows never take part in cascades.
+    """
+    original_id = models.BigIntegerField(unique=True)
+    patient_id = models.BigIntegerField()
+    scope = models.CharField(max_length=50)
+    token_number = models.IntegerField()
+    status = models.CharField(max_length=20)
+    queue_date = models.DateField(db_index=True)
+    created_at = models.DateTimeField()
+    called_at = models.DateTimeField(null=True, blank=True)
+    served_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Token {self.token_number} ({self.scope}, {self.queue_date})"
+
 # ------------------------
 # MedicalRecord
 # ------------------------
@@ -135,9 +301,57 @@ class Appointment(models.Model):
     date = models.DateTimeField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='scheduled')
     reminder_sent = models.BooleanField(default=False)  # For appointment reminders
+    # When the reminder goes out: REMINDER_LEAD before `date` while the
+    # appointment is scheduled, otherwise null. Kept up to date by save(),
+    # which also marks a moved appointment's reminder as unsent.
+    remind_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    REMINDER_LEAD = timedelta(hours=24)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination walks appointments by date, newest first
+            models.Index(fields=['date', 'id'], name='appointment_date_id'),
+            # The reminder sweep reads only reminders that are due and unsent
+            models.Index(
+                fields=['remind_at'], name='appointment_remind_at', condition=models.Q(reminder_sent=False)
+            ),
+        ]
     
     def __str__(self):
         return f"Appointment for {self.patient.name} with {self.doctor.name} on {self.date}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_remind_at = instance.__dict__.get('remind_at')
+        return instance
+
+    def compute_remind_at(self):
+        if self.status != 'scheduled' or self.date is None:
+            return None
+        return self.date - self.REMINDER_LEAD
+
+    def remind_at_changed(self):
+        """Whether remind_at differs from the value last saved."""
+        return self.remind_at != getattr(self, '_saved_remind_at', None)
+
+    def reschedule_reminder(self):
+        """
+        Set remind_at from date and status. An appointment moved to a new
+        time is owed a new reminder, even if it had one for the old time.
+        """
+        self.remind_at = self.compute_remind_at()
+        if not self._state.adding and self.remind_at is not None and self.remind_at_changed():
+            self.reminder_sent = False
+
+    def save(self, *args, **kwargs):
+        self.reschedule_reminder()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'date', 'status'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'remind_at', 'reminder_sent'}
+        super().save(*args, **kwargs)
+        self._saved_remind_at = self.remind_at
     
 
 # ------------------------
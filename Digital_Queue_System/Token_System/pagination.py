@@ -0,0 +1,19 @@
+# Token_System/pagination.py
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Default pagination for the API: pages are addressed by an opaque cursor
+    that encodes the last position seen, so every page is read with
+    WHERE <ordering field> > <position> LIMIT page_size on an index,
+    however deep into the table it is (no OFFSET scans).
+
+    Views set `ordering` to an indexed, (nearly) unique field; ?ordering=
+    from OrderingFilter takes precedence when given.
+    Pages hold PAGE_SIZE items; clients may ask for smaller or larger pages
+    with ?page_size=, up to max_page_size.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-pk'
@@ -0,0 +1,314 @@
+# Token_System/queueing.py
+from bisect import bisect_left
+
+from django.db import connection, transaction
+from django.db.models import Case, F, Max, Value, When
+from django.utils import timezone
+
+from .events import publish_queue_event
+from .models import Queue, QueueServiceStats, QueueTokenSequence
+
+DEFAULT_SCOPE = 'global'
+# Weight of the newest service time in the rolling average; higher values
+# follow changes in pace faster but jump around more
+SERVICE_TIME_SMOOTHING = 0.2
+# Timestamp set on an entry when it moves to each status
+STATUS_TIMESTAMPS = {'called': 'called_at', 'served': 'served_at'}
+
+
+def queue_scope(department_id=None, doctor_id=None):
+    """
+    Partition key of a queue: a doctor's own queue, a department's, or the
+    global one when neither is given.
+    """
+    if doctor_id:
+        return f"doctor:{int(doctor_id)}"
+    if department_id:
+        return f"department:{int(department_id)}"
+    return DEFAULT_SCOPE
+
+
+def _sequence_seed(day, scope):
+    """
+    Starting values for a new sequence row, taken from entries that already
+    exist for `day`. Only used once per day, when the row is created, so
+    entries issued before the counter existed are never numbered twice and
+    positions account for tokens that were already called.
+    """
+    entries = Queue.objects.filter(scope=scope, queue_date=day)
+    last_token = entries.aggregate(Max('token_number'))['token_number__max'] or 0
+    waiting = set(entries.filter(status='waiting').values_list('token_number', flat=True))
+    called_through = min(waiting) - 1 if waiting else last_token
+    departed_ahead = [
+        token for token in range(called_through + 1, last_token + 1) if token not in waiting
+    ]
+    return {
+        'last_token': last_token,
+        'called_through': called_through,
+        'departed_ahead': departed_ahead,
+    }
+
+
+def _get_sequence(day, scope):
+    try:
+        return QueueTokenSequence.objects.get(day=day, scope=scope)
+    except QueueTokenSequence.DoesNotExist:
+        sequence, _ = QueueTokenSequence.objects.get_or_create(
+            day=day, scope=scope, defaults=_sequence_seed(day, scope)
+        )
+        return sequence
+
+
+def allocate_tokens(count=1, scope=DEFAULT_SCOPE, day=None):
+    """
+    Reserve `count` consecutive token numbers for `scope` on `day` (today by
+    default) and return them as a range.
+
+    The counter row is bumped with a single UPDATE ... SET last_token =
+    last_token + count, which takes a row lock, so concurrent callers are
+    serialized on that one row and can never receive the same number.
+    """
+    if count < 1:
+        raise ValueError("count must be at least 1")
+
+    day = day or timezone.now().date()
+
+    with transaction.atomic():
+        sequence = _get_sequence(day, scope)
+        sequences = QueueTokenSequence.objects.filter(pk=sequence.pk)
+        sequences.update(last_token=F('last_token') + count)
+        last_token = sequences.values_list('last_token', flat=True).get()
+
+    return range(last_token - count + 1, last_token + 1)
+
+
+def allocate_token(scope=DEFAULT_SCOPE, day=None):
+    """Reserve and return the next token number for `scope`."""
+    return allocate_tokens(1, scope=scope, day=day)[0]
+
+
+def enqueue(patient, department=None, doctor=None):
+    """
+    Add `patient` to today's queue of `doctor`, of `department`, or to the
+    global queue, with the next token number of that queue. The number is
+    taken and the entry created in one transaction, so a failed insert never
+    leaves a gap.
+    """
+    return enqueue_many([patient], department=department, doctor=doctor)[0]
+
+
+def enqueue_many(patients, department=None, doctor=None):
+    """
+    Add several patients to the same queue in one go, e.g. a batch check-in
+    at the front desk. One contiguous block of tokens is reserved and all
+    entries are inserted with a single bulk INSERT; they are returned in the
+    order of `patients`.
+    """
+    patients = list(patients)
+    # A doctor's queue also belongs to the doctor's department
+    department_id = doctor.department_id if doctor else (department.id if department else None)
+    scope = queue_scope(department_id=department_id, doctor_id=doctor.id if doctor else None)
+    today = timezone.now().date()
+    with transaction.atomic():
+        tokens = allocate_tokens(len(patients), scope=scope, day=today)
+        entries = Queue.objects.bulk_create([
+            Queue(
+                patient=patient,
+                department_id=department_id,
+                doctor=doctor,
+                scope=scope,
+                token_number=token_number,
+                queue_date=today,
+                status='waiting'
+            )
+            for patient, token_number in zip(patients, tokens)
+        ])
+        for entry in entries:
+            publish_queue_event(scope, 'joined', entry)
+    return entries
+
+
+def record_departure(entry):
+    """
+    Note that `entry` has left the waiting line (called, served, skipped...)
+    and advance the day's called_through watermark past any run of departed
+    tokens. Recording the same token twice is harmless.
+
+    The watermark is moved once the current transaction commits, in a short
+    transaction of its own, so the claim transactions of concurrent counters
+    never queue up behind the lock on the sequence row. A failure there is
+    logged rather than raised at a counter whose claim has already been
+    saved; people_ahead() repairs the watermark it leaves behind.
+    """
+    day, scope, token = entry.queue_date, entry.scope, entry.token_number
+    transaction.on_commit(lambda: _advance_watermark(day, scope, token), robust=True)
+
+
+def _advance_watermark(day, scope, token):
+    with transaction.atomic():
+        sequence = QueueTokenSequence.objects.select_for_update().filter(day=day, scope=scope).first()
+        if sequence is None or token <= sequence.called_through or token in sequence.departed_ahead:
+            return
+
+        departed = set(sequence.departed_ahead)
+        departed.add(token)
+        called_through = sequence.called_through
+        while called_through + 1 in departed:
+            called_through += 1
+            departed.remove(called_through)
+
+        sequence.called_through = called_through
+        sequence.departed_ahead = sorted(departed)
+        sequence.save(update_fields=['called_through', 'departed_ahead'])
+
+
+def _repair_watermark(day, scope):
+    """
+    Recompute called_through / departed_ahead of `scope` on `day` from its
+    entries, as when the row is first created, and return them.
+    """
+    with transaction.atomic():
+        # Departures recorded meanwhile wait, and are applied on top
+        QueueTokenSequence.objects.select_for_update().filter(day=day, scope=scope).first()
+        seed = _sequence_seed(day, scope)
+        QueueTokenSequence.objects.filter(day=day, scope=scope).update(
+            called_through=seed['called_through'], departed_ahead=seed['departed_ahead']
+        )
+    return seed['called_through'], seed['departed_ahead']
+
+
+def people_ahead(entry):
+    """
+    How many tokens of the same queue are still waiting in front of `entry`,
+    in O(log n) from the sequence row instead of a COUNT over the queue:
+    all tokens below ours, minus those up to the watermark, minus those
+    that left out of order. The lowest waiting token (one index lookup)
+    confirms the watermark; if it trails, it is rebuilt from the entries.
+    """
+    sequence = QueueTokenSequence.objects.filter(
+        day=entry.queue_date, scope=entry.scope
+    ).values_list('called_through', 'departed_ahead').first()
+    if sequence is None:
+        return Queue.objects.filter(
+            scope=entry.scope,
+            queue_date=entry.queue_date,
+            status='waiting',
+            token_number__lt=entry.token_number
+        ).count()
+
+    called_through, departed_ahead = sequence
+    # The lowest waiting token is always the one right after the watermark,
+    # unless a departure failed to be recorded
+    lowest_waiting = Queue.objects.filter(
+        scope=entry.scope, queue_date=entry.queue_date, status='waiting'
+    ).order_by('token_number').values_list('token_number', flat=True).first()
+    if lowest_waiting is not None and lowest_waiting != called_through + 1:
+        called_through, departed_ahead = _repair_watermark(entry.queue_date, entry.scope)
+    ahead = entry.token_number - called_through - 1 - bisect_left(departed_ahead, entry.token_number)
+    return max(ahead, 0)
+
+
+def record_service(entry):
+    """
+    Fold the service time of a just-served `entry` (called -> served) into
+    the rolling average of its scope. The average is recomputed inside one
+    UPDATE, so concurrent serves never overwrite each other's samples.
+    Entries served without being called first carry no service time.
+
+    Like the watermark (see record_departure), the scope's row is updated
+    after the current transaction commits, so concurrent serves do not wait
+    on its lock; a failure only costs the sample and is logged.
+    """
+    if entry.called_at is None or entry.served_at is None:
+        return
+    sample = max((entry.served_at - entry.called_at).total_seconds(), 0.0)
+    scope = entry.scope
+    transaction.on_commit(lambda: _add_service_sample(scope, sample), robust=True)
+
+
+def _add_service_sample(scope, sample):
+    QueueServiceStats.objects.get_or_create(scope=scope)
+    QueueServiceStats.objects.filter(scope=scope).update(
+        avg_service_seconds=Case(
+            When(served_count=0, then=Value(sample)),
+            default=F('avg_service_seconds') + SERVICE_TIME_SMOOTHING * (Value(sample) - F('avg_service_seconds')),
+        ),
+        served_count=F('served_count') + 1,
+        updated_at=timezone.now(),
+    )
+
+
+def estimated_wait_minutes(entry, ahead):
+    """
+    Rough wait for `entry` with `ahead` people in front of it, from its
+    scope's average service time; None until the scope has served anyone.
+    """
+    average = QueueServiceStats.objects.filter(
+        scope=entry.scope, served_count__gt=0
+    ).values_list('avg_service_seconds', flat=True).first()
+    if average is None:
+        return None
+    return round(ahead * average / 60)
+
+
+def transition_entry(entry, status):
+    """
+    Move `entry` to `status` if that is allowed from the status it is in now
+    (see Queue.TRANSITIONS). The check and the write are one conditional
+    UPDATE, so two concurrent transitions cannot both succeed.
+    Returns True if the entry moved.
+    """
+    allowed_from = [
+        current for current, targets in Queue.TRANSITIONS.items() if status in targets
+    ]
+    changes = {'status': status}
+    if status in STATUS_TIMESTAMPS:
+        changes[STATUS_TIMESTAMPS[status]] = timezone.now()
+    with transaction.atomic():
+        moved = Queue.objects.filter(pk=entry.pk, status__in=allowed_from).update(**changes)
+        if moved:
+            for field, value in changes.items():
+                setattr(entry, field, value)
+            record_departure(entry)
+            if status == 'served':
+                record_service(entry)
+            publish_queue_event(entry.scope, status, entry)
+    return bool(moved)
+
+
+def claim_next(scope=DEFAULT_SCOPE):
+    """
+    Mark the lowest waiting token of today's `scope` queue as called and
+    return it, or None if nobody is waiting. Safe to run from many counters at once: each entry
+    is handed to exactly one caller.
+
+    On databases with SKIP LOCKED (PostgreSQL) the next row is locked and
+    rows already locked by another counter are skipped, so counters never
+    wait on each other. Elsewhere (SQLite) the entry is claimed with a
+    conditional UPDATE ... WHERE status = 'waiting', retrying with the next
+    candidate when another counter got there first.
+    """
+    waiting = Queue.objects.filter(
+        scope=scope,
+        queue_date=timezone.now().date(),
+        status='waiting'
+    ).order_by('token_number')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            entry = waiting.select_for_update(skip_locked=True).first()
+            if entry is None:
+                return None
+            entry.status = 'called'
+            entry.called_at = timezone.now()
+            entry.save(update_fields=['status', 'called_at'])
+            record_departure(entry)
+            publish_queue_event(scope, 'called', entry)
+            return entry
+
+    while True:
+        entry = waiting.first()
+        if entry is None:
+            return None
+        if transition_entry(entry, 'called'):
+            return entry
@@ -0,0 +1,208 @@
+# Token_System/read_serializers.py
+"""
+Fast read path for high-volume list endpoints.
+
+A ModelSerializer builds a model instance per row and runs every field's
+to_representation through DRF's generic machinery. For plain list output
+that is mostly wasted work, so ValuesReadSerializer reads rows with
+QuerySet.values() and turns them into the same dicts the ModelSerializer
+would produce, using a conversion plan worked out once per serializer:
+which column each output key comes from and whether the value needs
+converting at all (only dates and datetimes do for our models).
+
+Writes, retrieves and anything that needs validation keep using the
+regular serializers; FastListMixin only swaps the serializer for `list`.
+"""
+import threading
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .sparse_fields import requested_fields
+
+# Fields whose to_representation returns database values unchanged
+_PASSTHROUGH_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.FloatField,
+    serializers.IntegerField,
+    serializers.JSONField,
+    serializers.ModelField,
+    serializers.ReadOnlyField,
+)
+
+
+def _datetime_converter(field):
+    """
+    Factory taking the active time zone and returning a converter that
+    formats like serializers.DateTimeField, or None to pass values through.
+    """
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None:
+        return None
+    if output_format.lower() != ISO_8601:
+        return lambda tz: field.to_representation
+
+    def make(tz):
+        def convert(value):
+            if not value:
+                return None
+            if tz is None or not timezone.is_aware(value):
+                value = field.enforce_timezone(value)
+            else:
+                value = value.astimezone(tz)
+            value = value.isoformat()
+            if value.endswith('+00:00'):
+                value = value[:-6] + 'Z'
+            return value
+        return convert
+    return make
+
+
+def _date_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATE_FORMAT)
+    if output_format is None:
+        return None
+    if output_format.lower() != ISO_8601:
+        return lambda tz: field.to_representation
+    return lambda tz: lambda value: value.isoformat() if value else None
+
+
+class ValuesReadSerializer:
+    """
+    Produce the output of `serializer_class(queryset, many=True).data` from
+    values() rows.
+
+    Serializer fields map to columns by their source: a related field to
+    the foreign key column, a dotted source such as 'prescribed_by.name'
+    to a joined 'prescribed_by__name' column. Fields that are not backed by
+    a column (model properties) are listed in `computed` as
+    {field name: (column, function)}: the output is function(column value).
+
+    Both values() and to_representation() take an optional `fields`
+    collection of output names to produce only those (sparse fieldsets).
+    """
+
+    def __init__(self, serializer_class, computed=None):
+        self.serializer_class = serializer_class
+        self.computed = computed or {}
+        self._plan = None
+        self._lock = threading.Lock()
+
+    def _column(self, model, field):
+        # values('patient') yields the patient id, as PrimaryKeyRelatedField does
+        if isinstance(field, serializers.ManyRelatedField) or field.source == '*':
+            return None
+        if isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is not None:
+            return None
+
+        parts = field.source.split('.')
+        try:
+            model._meta.get_field(parts[0])
+        except FieldDoesNotExist:
+            return None
+        return '__'.join(parts)
+
+    def _compile(self):
+        model = self.serializer_class.Meta.model
+        plan = []
+        for name, field in self.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if name in self.computed:
+                column, function = self.computed[name]
+                plan.append((name, column, itemgetter(column), lambda tz, function=function: function))
+                continue
+
+            column = self._column(model, field)
+            if column is None:
+                raise ImproperlyConfigured(
+                    f"{self.serializer_class.__name__}.{name} is not a database column; "
+                    f"pass a function for it in `computed`."
+                )
+            if isinstance(field, serializers.DateTimeField):
+                factory = _datetime_converter(field)
+            elif isinstance(field, serializers.DateField):
+                factory = _date_converter(field)
+            elif isinstance(field, _PASSTHROUGH_FIELDS + (serializers.PrimaryKeyRelatedField,)):
+                factory = None
+            else:
+                factory = lambda tz, field=field: field.to_representation
+            plan.append((name, column, itemgetter(column), factory))
+        return plan
+
+    @property
+    def plan(self):
+        if self._plan is None:
+            with self._lock:
+                if self._plan is None:
+                    self._plan = self._compile()
+        return self._plan
+
+    def _steps(self, fields):
+        if fields is None:
+            return self.plan
+        return [step for step in self.plan if step[0] in fields]
+
+    def field_names(self, fields=None):
+        """Output keys, in order, for `fields` (all by default)."""
+        return [name for name, _, _, _ in self._steps(fields)]
+
+    def values(self, queryset, extra=(), fields=None):
+        """
+        `queryset` as values() rows with every column the output needs, plus
+        `extra` columns (e.g. the ones a paginator reads positions from).
+        """
+        columns = []
+        for _, column, _, _ in self._steps(fields):
+            if column not in columns:
+                columns.append(column)
+        return queryset.values(*columns, *[column for column in extra if column not in columns])
+
+    def to_representation(self, rows, fields=None):
+        """Serialize values() rows into a list of output dicts."""
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        steps = [
+            (name, getter, factory(tz) if factory else None)
+            for name, _, getter, factory in self._steps(fields)
+        ]
+        data = []
+        for row in rows:
+            item = {}
+            for name, getter, convert in steps:
+                value = getter(row)
+                item[name] = convert(value) if convert is not None and value is not None else value
+            data.append(item)
+        return data
+
+
+class FastListMixin:
+    """
+    Serve a ViewSet's `list` action through `read_serializer`, a
+    ValuesReadSerializer, including filtering, pagination and ?fields=.
+    Lists with ?expand= need nested serializers and take the regular path.
+    """
+    read_serializer = None
+
+    def list(self, request, *args, **kwargs):
+        if 'expand' in request.query_params:
+            return super().list(request, *args, **kwargs)
+
+        fields = requested_fields(request)
+        queryset = self.filter_queryset(self.get_queryset())
+        # Cursor pagination reads its position from the ordering columns
+        ordering = ()
+        if hasattr(self.paginator, 'get_ordering'):
+            ordering = [field.lstrip('-') for field in self.paginator.get_ordering(request, queryset, self)]
+        queryset = self.read_serializer.values(queryset, extra=ordering, fields=fields)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.read_serializer.to_representation(page, fields=fields))
+        return Response(self.read_serializer.to_representation(queryset, fields=fields))
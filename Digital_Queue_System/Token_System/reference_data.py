@@ -0,0 +1,98 @@
+# Token_System/reference_data.py
+"""
+Process-local cache of reference data: departments and doctors.
+
+These tables change a few times a year but are read on nearly every
+request (doctor lists, queue joins, serializer validation, new doctor
+profiles). Each worker keeps the whole table in memory for up to
+REFERENCE_TTL seconds. Writes bump a generation number in the shared cache
+(see signals.py) once they commit. Every worker compares its copy with
+that number on each read and reloads when it has moved on, so a change
+made through one worker is seen by all of them on their next read.
+
+Lookups by id that miss fall through to the database, so a row created a
+moment ago is found even before the generation change is seen. Cached
+objects are shared between requests and must not be modified.
+"""
+import threading
+import time
+
+from rest_framework.response import Response
+
+from .cache_versions import bump_version, get_version
+from .models import Department, Doctor
+
+# Upper bound on how long a copy is used if the generation key is lost
+REFERENCE_TTL = 300
+
+
+class ReferenceCache:
+    """All rows of `queryset`, ordered by primary key, held in memory."""
+
+    def __init__(self, name, queryset):
+        self.name = name
+        self.queryset = queryset
+        self._generation_key = f"reference-data:generation:{name}"
+        self._lock = threading.Lock()
+        # (generation, loaded at, {pk: object})
+        self._state = (None, 0.0, {})
+
+    def __deepcopy__(self, memo):
+        # Shared by every serializer field that names it
+        return self
+
+    def _rows(self):
+        generation = get_version(self._generation_key, None)
+        current, loaded_at, rows = self._state
+        if current == generation and time.monotonic() - loaded_at < REFERENCE_TTL:
+            return rows
+        with self._lock:
+            current, loaded_at, rows = self._state
+            if current != generation or time.monotonic() - loaded_at >= REFERENCE_TTL:
+                rows = {obj.pk: obj for obj in self.queryset.order_by('pk')}
+                self._state = (generation, time.monotonic(), rows)
+        return rows
+
+    def all(self):
+        return list(self._rows().values())
+
+    def in_bulk(self):
+        """{pk: object} for every row."""
+        return self._rows()
+
+    def get(self, pk):
+        """The row with primary key `pk`; raises DoesNotExist like QuerySet.get()."""
+        try:
+            return self._rows()[int(pk)]
+        except KeyError:
+            return self.queryset.get(pk=pk)
+
+    def invalidate(self):
+        """Make every worker reload on its next read."""
+        self._state = (None, 0.0, {})
+        bump_version(self._generation_key, None)
+
+
+departments = ReferenceCache('departments', Department.objects.all())
+doctors = ReferenceCache('doctors', Doctor.objects.select_related('department'))
+
+
+class ReferenceListMixin:
+    """
+    Serve a ViewSet's plain `list` (no query parameters) from `reference`,
+    a ReferenceCache, as long as every row fits on the first page.
+    Filtered, ordered, sparse or further pages take the regular path.
+    """
+    reference = None
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().list(request, *args, **kwargs)
+        rows = self.reference.all()
+        paginator = self.paginator
+        if paginator is None:
+            return Response(self.get_serializer(rows, many=True).data)
+        if len(rows) > paginator.get_page_size(request):
+            return super().list(request, *args, **kwargs)
+        # The single page cursor pagination would return
+        return Response({'next': None, 'previous': None, 'results': self.get_serializer(rows, many=True).data})
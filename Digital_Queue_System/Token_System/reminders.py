@@ -0,0 +1,127 @@
+# Token_System/reminders.py
+import smtplib
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .history_cache import invalidate_history
+from .models import Appointment
+
+# Appointments this close get their reminder
+REMINDER_WINDOW = Appointment.REMINDER_LEAD
+# Reminders claimed (and dispatched) per step of the sweep
+REMINDER_BATCH_SIZE = 500
+# Reminders sent by one delivery task, over one mail server connection
+REMINDER_SEND_CHUNK = 100
+
+
+def due_reminders(now=None):
+    """
+    Unsent reminders whose time (remind_at) has come, for appointments
+    still ahead. Read through the partial remind_at index, so only due rows
+    are touched however many appointments are booked.
+    """
+    now = now or timezone.now()
+    return Appointment.objects.filter(
+        remind_at__lte=now,
+        date__gte=now,
+        reminder_sent=False
+    ).order_by('remind_at', 'pk')
+
+
+def claim_reminders(now=None, batch_size=REMINDER_BATCH_SIZE):
+    """
+    Mark up to `batch_size` due reminders as sent and return their
+    appointment ids. Safe to run from several workers at once: each
+    reminder is claimed by exactly one of them.
+
+    On databases with SKIP LOCKED (PostgreSQL) the batch is locked and rows
+    already locked by another sweep are skipped. On SQLite the transaction
+    holds the write lock from its start (IMMEDIATE mode), so no other sweep
+    can claim between the SELECT and the conditional UPDATE.
+
+    The UPDATE sends no signals, so the patients' cached histories are
+    expired here once the claim commits.
+    """
+    due = due_reminders(now)
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        rows = list(due.values_list('pk', 'patient_id')[:batch_size])
+        ids = [pk for pk, _ in rows]
+        if ids:
+            Appointment.objects.filter(pk__in=ids, reminder_sent=False).update(reminder_sent=True)
+            patient_ids = [patient_id for _, patient_id in rows]
+            transaction.on_commit(lambda: invalidate_history(*patient_ids))
+    return ids
+
+
+def release_reminders(appointment_ids):
+    """
+    Mark claimed reminders as unsent again, e.g. when their delivery could
+    not be queued, so a later sweep picks them up.
+    """
+    with transaction.atomic():
+        Appointment.objects.filter(pk__in=appointment_ids).update(reminder_sent=False)
+        patient_ids = list(
+            Appointment.objects.filter(pk__in=appointment_ids).values_list('patient_id', flat=True)
+        )
+        transaction.on_commit(lambda: invalidate_history(*patient_ids))
+
+
+def reminder_message(appointment):
+    """The reminder email for `appointment` (patient and doctor loaded)."""
+    patient = appointment.patient
+    doctor = appointment.doctor
+    subject = f"Appointment Reminder: {appointment.date.strftime('%Y-%m-%d %H:%M')}"
+    message = f"""
+        Hello {patient.name},
+        
+        This is a reminder for your appointment with Dr. {doctor.name}
+        on {appointment.date.strftime('%A, %B %d, %Y at %I:%M %p')}.
+        
+        Please arrive 15 minutes early.
+        
+        Thank you,
+        {settings.SITE_NAME}
+        """
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [patient.email])
+
+
+def deliver_reminders(appointment_ids):
+    """
+    Send the reminders of `appointment_ids` and return the ids whose email
+    could not be sent. The appointments are read with one query and every
+    message goes over the same mail server connection; a failed message
+    does not stop the others. Ids of deleted appointments are skipped.
+    """
+    appointments = list(Appointment.objects.filter(pk__in=appointment_ids).select_related('patient', 'doctor'))
+    failed = []
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+    except (smtplib.SMTPException, OSError):
+        # Mail server unreachable: nothing was sent
+        return list(appointment_ids)
+    try:
+        for index, appointment in enumerate(appointments):
+            try:
+                mail_connection.send_messages([reminder_message(appointment)])
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # Only this message was rejected; the connection stays usable
+                failed.append(appointment.pk)
+            except (smtplib.SMTPException, OSError):
+                # Connection lost (SMTPException is an OSError): reconnect
+                # for the rest of the batch
+                failed.append(appointment.pk)
+                mail_connection.close()
+                try:
+                    mail_connection.open()
+                except (smtplib.SMTPException, OSError):
+                    failed.extend(rest.pk for rest in appointments[index + 1:])
+                    break
+    finally:
+        mail_connection.close()
+    return failed
@@ -1,10 +1,14 @@
+from django.core.exceptions import ObjectDoesNotExist
 from rest_framework import serializers
+from .read_serializers import ValuesReadSerializer
+from .reference_data import departments, doctors
+from .sparse_fields import DynamicFieldsMixin
 from .models import Department, Diagnosis, Doctor, MedicalNote, Patient, Appointment, Queue, Treatment, User, MedicalRecord
 
 # ------------------------
 # User Serializer
 # ------------------------
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     date_of_birth = serializers.DateField(required=True)
     class Meta:
         model = User
@@ -16,10 +20,32 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
+class ReferencePrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField validated against a reference_data cache
+    (departments, doctors) instead of a query per value.
+    """
+
+    def __init__(self, reference, **kwargs):
+        self.reference = reference
+        kwargs.setdefault('queryset', reference.queryset)
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return self.reference.get(data)
+        except ObjectDoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
 # ------------------------
 # Department Serializer
 # ------------------------
-class DepartmentSerializer(serializers.ModelSerializer):
+class DepartmentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Department
         fields = '__all__'
@@ -28,10 +54,11 @@ class DepartmentSerializer(serializers.ModelSerializer):
 # ------------------------
 # Doctor Serializer
 # ------------------------
-class DoctorSerializer(serializers.ModelSerializer):
-    department = DepartmentSerializer(read_only=True)
-    department_id = serializers.PrimaryKeyRelatedField(
-        queryset=Department.objects.all(),
+class DoctorSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    # The department's id, or the whole department with ?expand=department
+    expandable_fields = {'department': DepartmentSerializer}
+    department_id = ReferencePrimaryKeyRelatedField(
+        departments,
         source='department',
         write_only=True
     )
@@ -39,12 +66,13 @@ class DoctorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Doctor
         fields = ['id', 'name', 'specialty', 'department', 'department_id']
+        read_only_fields = ['department']
 
 
 # ------------------------
 # Patient Serializer
 # ------------------------
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user_id = serializers.IntegerField(source='user.id', read_only=True)
     username = serializers.CharField(source='user.username', read_only=True)
     class Meta:
@@ -55,24 +83,67 @@ class PatientSerializer(serializers.ModelSerializer):
 # ------------------------
 # Appointment Serializer
 # ------------------------
-class AppointmentSerializer(serializers.ModelSerializer):
+class AppointmentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'patient': PatientSerializer, 'doctor': DoctorSerializer}
+    doctor = ReferencePrimaryKeyRelatedField(doctors)
+
     class Meta:
         model = Appointment
         fields = '__all__'
 
 
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField that looks the object up in
+    context['prefetched'][model], a {pk: object} dict such as in_bulk()
+    returns, instead of running a query per value.
+    """
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.queryset.model)
+        if prefetched is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in prefetched:
+            self.fail('does_not_exist', pk_value=data)
+        return prefetched[pk]
+
+
+class AppointmentBulkSerializer(AppointmentSerializer):
+    """One item of a bulk create/update; patients and doctors come prefetched."""
+    patient = PrefetchedPrimaryKeyRelatedField(queryset=Patient.objects.all())
+    doctor = PrefetchedPrimaryKeyRelatedField(queryset=Doctor.objects.all())
+
+
 # ------------------------
 # Queue Serializer
 # ------------------------
-class QueueSerializer(serializers.ModelSerializer):
+class QueueSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'patient': PatientSerializer, 'department': DepartmentSerializer, 'doctor': DoctorSerializer
+    }
+    department = ReferencePrimaryKeyRelatedField(departments, allow_null=True, required=False)
+    doctor = ReferencePrimaryKeyRelatedField(doctors, allow_null=True, required=False)
+    # Kept for clients written against the old is_called/is_served flags
+    is_called = serializers.BooleanField(read_only=True)
+    is_served = serializers.BooleanField(read_only=True)
+
     class Meta:
         model = Queue
         fields = '__all__'
+        # Managed by the queue actions (join_queue, call_next, mark_served, ...)
+        read_only_fields = ['scope', 'token_number', 'status', 'queue_date', 'called_at', 'served_at']
+
 
 # ------------------------
 # User Profile Serializer
 # ------------------------
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'role', 'date_of_birth', 'first_name', 'last_name']
@@ -88,7 +159,8 @@ class UserProfileSerializer(serializers.ModelSerializer):
 # ------------------------
 # Medical Record Serializer
 # ------------------------
-class MedicalRecordSerializer(serializers.ModelSerializer):
+class MedicalRecordSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'patient': PatientSerializer}
     patient_name = serializers.CharField(source='patient.name', read_only=True)
     
     class Meta:
@@ -104,7 +176,8 @@ class MedicalRecordSerializer(serializers.ModelSerializer):
 # ------------------------
 # Treatment Serializer
 # ------------------------
-class TreatmentSerializer(serializers.ModelSerializer):
+class TreatmentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'prescribed_by': DoctorSerializer}
     prescribed_by_name = serializers.CharField(source='prescribed_by.name', read_only=True)
     
     class Meta:
@@ -114,7 +187,7 @@ class TreatmentSerializer(serializers.ModelSerializer):
 # ------------------------
 # Diagnosis Serializer
 # ------------------------
-class DiagnosisSerializer(serializers.ModelSerializer):
+class DiagnosisSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Diagnosis
         fields = '__all__'
@@ -122,7 +195,8 @@ class DiagnosisSerializer(serializers.ModelSerializer):
 # ------------------------
 # Medical Note Serializer
 # ------------------------
-class MedicalNoteSerializer(serializers.ModelSerializer):
+class MedicalNoteSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'created_by': DoctorSerializer}
     created_by_name = serializers.CharField(source='created_by.name', read_only=True)
     
     class Meta:
@@ -132,7 +206,7 @@ class MedicalNoteSerializer(serializers.ModelSerializer):
 # ------------------------------------
 # Patient Medical History Serializer
 # -------------------------------------
-class PatientMedicalHistorySerializer(serializers.ModelSerializer):
+class PatientMedicalHistorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     appointments = AppointmentSerializer(many=True, read_only=True)
     treatments = TreatmentSerializer(many=True, read_only=True)
     diagnoses = DiagnosisSerializer(many=True, read_only=True)
@@ -145,4 +219,19 @@ class PatientMedicalHistorySerializer(serializers.ModelSerializer):
             'id', 'name', 'email', 'phone', 'date_of_birth',
             'appointments', 'treatments', 'diagnoses', 
             'medical_notes', 'medical_record'
-        ]
\ No newline at end of file
+        ]
+
+
+# ------------------------
+# Fast List Serializers
+# ------------------------
+# Same output as the serializers above, read from values() rows (see read_serializers.py)
+UserReadSerializer = ValuesReadSerializer(UserSerializer)
+AppointmentReadSerializer = ValuesReadSerializer(AppointmentSerializer)
+QueueReadSerializer = ValuesReadSerializer(QueueSerializer, computed={
+    'is_called': ('status', lambda status: status != 'waiting'),
+    'is_served': ('status', lambda status: status == 'served'),
+})
+TreatmentReadSerializer = ValuesReadSerializer(TreatmentSerializer)
+DiagnosisReadSerializer = ValuesReadSerializer(DiagnosisSerializer)
+MedicalNoteReadSerializer = ValuesReadSerializer(MedicalNoteSerializer)
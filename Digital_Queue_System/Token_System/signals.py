@@ -1,7 +1,12 @@
 # Token_System/signals.py
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
-from .models import User, Patient, Doctor, Department
+from rest_framework.authtoken.models import Token
+from .authentication import forget_token, forget_user_tokens
+from .history_cache import invalidate_doctor_names, invalidate_history
+from .reference_data import departments, doctors
+from .models import Appointment, Diagnosis, MedicalNote, MedicalRecord, Treatment, User, Patient, Doctor, Department
 
 @receiver(post_save, sender=User)
 def auto_create_patient_profile(sender, instance, created, **kwargs):
@@ -19,26 +24,45 @@ def auto_create_patient_profile(sender, instance, created, **kwargs):
             date_of_birth=instance.date_of_birth
         )
 
+# Patient profile column each tracked User field is copied to
+PATIENT_PROFILE_COLUMNS = {'username': 'name', 'email': 'email', 'date_of_birth': 'date_of_birth'}
+
+
 @receiver(post_save, sender=User)
-def update_patient_profile(sender, instance, **kwargs):
+def update_patient_profile(sender, instance, created, update_fields=None, **kwargs):
     """
-    If user updates their info, also update their Patient profile
+    If user updates their info, also update their Patient profile.
+    Only runs when a copied field (or the role) actually changed, so saves
+    such as the last_login update on each login write nothing here.
     """
-    if instance.role == 'patient':
-        try:
-            patient_profile = instance.patient_profile
-            patient_profile.name = instance.username
-            patient_profile.email = instance.email
-            patient_profile.date_of_birth = instance.date_of_birth
-            patient_profile.save()
-        except Patient.DoesNotExist:
-            # If patient profile doesn't exist but should, create it
-            Patient.objects.create(
-                user=instance,
-                name=instance.username,
-                email=instance.email,
-                date_of_birth=instance.date_of_birth
-            )
+    if created or instance.role != 'patient':
+        # New patients get their profile from auto_create_patient_profile
+        return
+    changed = instance.changed_fields()
+    if update_fields is not None:
+        changed = [name for name in changed if name in update_fields]
+    if not changed:
+        return
+
+    try:
+        patient_profile = instance.patient_profile
+    except Patient.DoesNotExist:
+        # If patient profile doesn't exist but should, create it
+        Patient.objects.create(
+            user=instance,
+            name=instance.username,
+            email=instance.email,
+            date_of_birth=instance.date_of_birth
+        )
+        return
+
+    columns = []
+    for name in changed:
+        if name in PATIENT_PROFILE_COLUMNS:
+            setattr(patient_profile, PATIENT_PROFILE_COLUMNS[name], getattr(instance, name))
+            columns.append(PATIENT_PROFILE_COLUMNS[name])
+    if columns:
+        patient_profile.save(update_fields=columns)
 
 @receiver(post_save, sender=User)
 def auto_create_doctor_profile(sender, instance, created, **kwargs):
@@ -48,10 +72,14 @@ def auto_create_doctor_profile(sender, instance, created, **kwargs):
     """
     if created and instance.role == 'doctor':
         
-        default_department, created = Department.objects.get_or_create(
-            name="General Medicine",
-            defaults={'description': 'Default department for new doctors'}
+        default_department = next(
+            (department for department in departments.all() if department.name == "General Medicine"), None
         )
+        if default_department is None:
+            default_department, created = Department.objects.get_or_create(
+                name="General Medicine",
+                defaults={'description': 'Default department for new doctors'}
+            )
         
         # Doctor profile linked to this User
         Doctor.objects.create(
@@ -59,4 +87,103 @@ def auto_create_doctor_profile(sender, instance, created, **kwargs):
             name=instance.username,  
             specialty="General Practice",  
             department=default_department
-        )
\ No newline at end of file
+        )
+
+
+# ------------------------
+# Medical history cache
+# ------------------------
+# Models shown in a patient's medical history: how to reach the patient
+HISTORY_MODELS = {
+    Appointment: 'patient_id',
+    MedicalRecord: 'patient_id',
+    Treatment: 'appointment__patient_id',
+    Diagnosis: 'appointment__patient_id',
+    MedicalNote: 'appointment__patient_id',
+}
+
+
+def _history_patient(instance):
+    """Id of the patient whose history `instance` belongs to."""
+    if HISTORY_MODELS[type(instance)] == 'patient_id':
+        return instance.patient_id
+    if type(instance).appointment.is_cached(instance):
+        return instance.appointment.patient_id
+    return Appointment.objects.filter(pk=instance.appointment_id).values_list('patient_id', flat=True).first()
+
+
+def _invalidate_on_commit(*patient_ids):
+    transaction.on_commit(lambda: invalidate_history(*patient_ids))
+
+
+def remember_history_patient(sender, instance, **kwargs):
+    """An update may move the row to another patient; note the current one."""
+    if not instance._state.adding:
+        instance._history_patients = list(
+            sender.objects.filter(pk=instance.pk).values_list(HISTORY_MODELS[sender], flat=True)
+        )
+
+
+def history_row_saved(sender, instance, **kwargs):
+    _invalidate_on_commit(_history_patient(instance), *getattr(instance, '_history_patients', ()))
+
+
+def history_row_deleted(sender, instance, **kwargs):
+    # Before the delete, while the appointment can still be looked up
+    _invalidate_on_commit(_history_patient(instance))
+
+
+for model in HISTORY_MODELS:
+    pre_save.connect(remember_history_patient, sender=model, dispatch_uid=f'history-pre-save-{model.__name__}')
+    post_save.connect(history_row_saved, sender=model, dispatch_uid=f'history-saved-{model.__name__}')
+    pre_delete.connect(history_row_deleted, sender=model, dispatch_uid=f'history-deleted-{model.__name__}')
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def patient_changed(sender, instance, **kwargs):
+    _invalidate_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+def doctor_changed(sender, instance, **kwargs):
+    # Doctor names appear in every history
+    transaction.on_commit(invalidate_doctor_names)
+    transaction.on_commit(doctors.invalidate)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def department_changed(sender, instance, **kwargs):
+    # Cached doctors carry their department
+    transaction.on_commit(departments.invalidate)
+    transaction.on_commit(doctors.invalidate)
+
+
+# ------------------------
+# Cached token principals
+# ------------------------
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    # Read now: the key is the primary key, which delete() clears
+    key, user_id = instance.key, instance.user_id
+    transaction.on_commit(lambda: forget_token(key, user_id))
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, **kwargs):
+    # Password, role and active flag are all part of the cached principal
+    if not created:
+        user_id = instance.pk
+        transaction.on_commit(lambda: forget_user_tokens(user_id))
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+def profile_changed(sender, instance, **kwargs):
+    user_id = instance.user_id
+    if user_id is not None:
+        transaction.on_commit(lambda: forget_user_tokens(user_id))
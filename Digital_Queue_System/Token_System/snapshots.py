@@ -0,0 +1,54 @@
+# Token_System/snapshots.py
+"""
+Cached, versioned copy of today's queue for GET /api/queues/.
+
+Display screens poll the list every few seconds although it only changes
+when a token joins, is called, served, skipped or the queue is reset. The
+serialized list is therefore kept in the cache under a version number per
+day and scope, and every change bumps that version once its transaction
+commits. The version doubles as the ETag, so a poll for an unchanged queue
+costs one cache read and returns 304 (see cache_versions.py for how the
+versions keep stale snapshots from being served).
+"""
+from django.core.cache import cache
+from django.utils import timezone
+
+from .cache_versions import bump_version, get_version
+
+# Version of the unfiltered list, which contains every scope
+ALL_SCOPES = '*'
+# Snapshots are per day; keep them a little over one
+SNAPSHOT_TIMEOUT = 60 * 60 * 25
+
+
+def _version_key(day, scope):
+    return f"queue-snapshot:version:{day}:{scope}"
+
+
+def snapshot_version(day, scope=ALL_SCOPES):
+    """Current version of the `scope` snapshot for `day`."""
+    return get_version(_version_key(day, scope), SNAPSHOT_TIMEOUT)
+
+
+def snapshot_etag(day, scope, version):
+    return f'"queue-{day}-{scope}-{version}"'
+
+
+def get_snapshot(day, scope, version, build):
+    """
+    The serialized list for `scope` at `version`, calling `build()` to
+    produce it from the database when it is not cached yet.
+    """
+    key = f"queue-snapshot:data:{day}:{scope}:{version}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, SNAPSHOT_TIMEOUT)
+    return data
+
+
+def invalidate_snapshot(scope, day=None):
+    """Bump the versions of the `scope` snapshot and of the unfiltered one."""
+    day = day or timezone.now().date()
+    for key in (_version_key(day, scope), _version_key(day, ALL_SCOPES)):
+        bump_version(key, SNAPSHOT_TIMEOUT)
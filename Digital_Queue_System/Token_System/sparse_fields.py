@@ -0,0 +1,114 @@
+# Token_System/sparse_fields.py
+"""
+Sparse fieldsets and on-demand expansion for GET requests.
+
+    ?fields=id,token_number    only these keys in each object
+    ?expand=department         nest the related object instead of its id
+
+Serializers opt in with DynamicFieldsMixin and list the relations that can
+be expanded in `expandable_fields`. ViewSets add SparseFieldsetMixin so the
+query follows the output: only() loads just the requested columns and
+expanded relations are joined in with select_related().
+"""
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def _field_list(request, param):
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def requested_fields(request):
+    """Names asked for with ?fields=, or None for all of them."""
+    return _field_list(request, 'fields')
+
+
+def requested_expansions(request):
+    """Relations asked for with ?expand= (empty if none)."""
+    return _field_list(request, 'expand') or set()
+
+
+class DynamicFieldsMixin:
+    """
+    ModelSerializer mixin honouring ?fields= and ?expand= on the request in
+    the serializer context. Only the top-level serializer of a response
+    reacts to them; nested ones always render in full.
+
+    expandable_fields maps a relation field to the serializer class that
+    renders it when expanded; otherwise it stays the related object's id.
+    """
+    expandable_fields = {}
+
+    def _is_top_level(self):
+        parent = self.parent
+        return parent is None or (isinstance(parent, serializers.ListSerializer) and parent.parent is None)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        top_level = self._is_top_level()
+        expand = requested_expansions(request) if top_level else set()
+
+        for name, serializer_class in self.expandable_fields.items():
+            if name in expand and name in fields:
+                fields[name] = serializer_class(read_only=True)
+
+        only = requested_fields(request) if top_level else None
+        if only is not None:
+            for name in list(fields):
+                if name not in only and not fields[name].write_only:
+                    del fields[name]
+        return fields
+
+
+def narrow_queryset(queryset, fields, extra=()):
+    """
+    Restrict `queryset` to the columns the serializer `fields` read, plus
+    `extra` ones, and join the relations they traverse. Left unchanged
+    when a field reads something other than a model field (e.g. a
+    property), since its columns cannot be known.
+    """
+    model = queryset.model
+    only = {model._meta.pk.name, *extra}
+    related = set()
+    for field in fields:
+        if field.write_only:
+            continue
+        if field.source == '*':
+            return queryset
+        parts = field.source.split('.')
+        try:
+            model_field = model._meta.get_field(parts[0])
+        except FieldDoesNotExist:
+            return queryset
+        if not model_field.concrete or model_field.many_to_many:
+            return queryset
+        only.add(parts[0])
+        if len(parts) > 1 or isinstance(field, serializers.BaseSerializer):
+            related.add(parts[0])
+
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset.only(*only)
+
+
+class SparseFieldsetMixin:
+    """ViewSet mixin loading only what ?fields= / ?expand= ask for."""
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        request = self.request
+        if requested_fields(request) is None and not requested_expansions(request):
+            return queryset
+
+        extra = ()
+        if hasattr(self.paginator, 'get_ordering'):
+            # Positions are read from the ordering columns
+            extra = [field.lstrip('-') for field in self.paginator.get_ordering(request, queryset, self)]
+        return narrow_queryset(queryset, self.get_serializer().fields.values(), extra)
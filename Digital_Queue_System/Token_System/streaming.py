@@ -0,0 +1,192 @@
+# Token_System/streaming.py
+"""
+Streamed JSON, NDJSON and CSV responses for large exports.
+
+DRF renders a whole response in memory before sending the first byte. The
+export actions instead read rows with QuerySet.iterator(), serialize them a
+chunk at a time with a ValuesReadSerializer and send each chunk as soon as
+it is encoded, so a worker only ever holds one chunk however many rows are
+exported. The export_records management command uses the same generators.
+
+Under ASGI, Django reads a synchronous streaming iterator to the end before
+sending anything, so there the chunks are handed over as an async iterator
+that produces each one in the sync thread as it is needed.
+
+orjson is used for encoding when it is installed, the standard json module
+(with Django's encoder) otherwise.
+"""
+import csv
+import io
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
+from rest_framework.permissions import BasePermission
+
+from .exports import filter_export, parse_export_filters
+from .sparse_fields import requested_fields
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+# Rows fetched from the database and encoded per step
+STREAM_CHUNK_SIZE = 2000
+
+
+def dumps(data):
+    """Encode `data` as compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(data, default=DjangoJSONEncoder().default)
+    return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def iter_chunks(rows, chunk_size=STREAM_CHUNK_SIZE):
+    """Split the iterable `rows` into lists of at most `chunk_size` items."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def serialized_chunks(queryset, read_serializer, chunk_size=STREAM_CHUNK_SIZE, fields=None):
+    """
+    Rows of `queryset` serialized with `read_serializer`, as lists of at
+    most `chunk_size` dicts. Rows are fetched with iterator(), which uses a
+    server-side cursor on PostgreSQL, so only one chunk is held at a time.
+    """
+    rows = read_serializer.values(queryset, fields=fields).iterator(chunk_size=chunk_size)
+    for chunk in iter_chunks(rows, chunk_size):
+        yield read_serializer.to_representation(chunk, fields=fields)
+
+
+def encode_json(chunks, field_names):
+    yield b'['
+    separator = b''
+    for chunk in chunks:
+        # Encode the whole chunk at once and drop its brackets
+        yield separator + dumps(chunk)[1:-1]
+        separator = b','
+    yield b']'
+
+
+def encode_ndjson(chunks, field_names):
+    """One JSON object per line."""
+    for chunk in chunks:
+        yield b''.join(dumps(row) + b'\n' for row in chunk)
+
+
+def encode_csv(chunks, field_names):
+    """A header row with the field names, then one line per row."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(field_names)
+    for chunk in chunks:
+        writer.writerows(row.values() for row in chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+# ?output= value: (content type, file extension, encoder)
+OUTPUT_FORMATS = {
+    'json': ('application/json', 'json', encode_json),
+    'ndjson': ('application/x-ndjson', 'ndjson', encode_ndjson),
+    'csv': ('text/csv', 'csv', encode_csv),
+}
+
+
+def stream_export(queryset, read_serializer, output='json', chunk_size=STREAM_CHUNK_SIZE, fields=None):
+    """Yield `queryset` encoded as `output` (see OUTPUT_FORMATS), chunk by chunk."""
+    encode = OUTPUT_FORMATS[output][2]
+    chunks = serialized_chunks(queryset, read_serializer, chunk_size, fields)
+    return encode(chunks, read_serializer.field_names(fields))
+
+
+def stream_json_array(queryset, read_serializer, chunk_size=STREAM_CHUNK_SIZE, fields=None):
+    """Yield `queryset` as one JSON array, in pieces of `chunk_size` rows."""
+    return stream_export(queryset, read_serializer, 'json', chunk_size, fields)
+
+
+async def _async_chunks(chunks):
+    next_chunk = sync_to_async(next)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def streaming_export_response(queryset, read_serializer, output='json', filename=None, fields=None,
+                              asynchronous=False):
+    """
+    The export as a StreamingHttpResponse; pass `asynchronous` when serving
+    an ASGI request.
+    """
+    content_type, extension, _ = OUTPUT_FORMATS[output]
+    chunks = stream_export(queryset, read_serializer, output, fields=fields)
+    response = StreamingHttpResponse(
+        _async_chunks(chunks) if asynchronous else chunks,
+        content_type=content_type,
+    )
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}.{extension}"'
+    return response
+
+
+class CanExport(BasePermission):
+    """Signed-in admins, or users whose role is in the view's `export_roles`."""
+
+    def has_permission(self, request, view):
+        user = request.user
+        if not (user and user.is_authenticated):
+            return False
+        return user.is_staff or user.role in view.export_roles
+
+
+class StreamingExportMixin:
+    """
+    Adds GET .../export/ to a ViewSet: every row of the filtered queryset,
+    unpaginated, streamed through `read_serializer`. Only users allowed by
+    CanExport may export.
+
+    ?output=json (default), ndjson or csv picks the format. ?fields= applies;
+    related objects are not expanded. Views naming an `export_name` from
+    exports.EXPORTS also accept ?date_from=, ?date_to= and ?department_id=.
+    """
+    export_name = None
+    export_roles = ('doctor', 'staff', 'admin')
+
+    @action(detail=False, methods=['get'], permission_classes=[CanExport])
+    def export(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'json')
+        if output not in OUTPUT_FORMATS:
+            raise ParseError({"error": f"output must be one of: {', '.join(OUTPUT_FORMATS)}."})
+
+        queryset = self.filter_queryset(self.get_queryset())
+        filename = self.basename
+        if self.export_name:
+            try:
+                filters = parse_export_filters(request.query_params)
+            except ValueError as error:
+                raise ParseError({"error": str(error)})
+            queryset = filter_export(queryset, self.export_name, **filters)
+            filename = self.export_name
+
+        return streaming_export_response(
+            queryset, self.read_serializer, output,
+            filename=filename if output != 'json' else None,
+            fields=requested_fields(request),
+            asynchronous=isinstance(request._request, ASGIRequest),
+        )
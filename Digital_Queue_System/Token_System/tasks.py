@@ -1,63 +1,69 @@
-from celery import shared_task
-from django.conf import settings
-from django.core.mail import send_mail
-from django.utils import timezone
-from datetime import timedelta
-from .models import Appointment
+from celery import group, shared_task
+from celery.exceptions import MaxRetriesExceededError
+from .archiving import archive_old_entries
+from .reminders import (
+    REMINDER_BATCH_SIZE, REMINDER_SEND_CHUNK, claim_reminders, deliver_reminders, release_reminders
+)
 
-@shared_task
-def send_appointment_reminder(appointment_id):
+# Attempts per reminder after the first, and the wait between them (seconds)
+REMINDER_MAX_RETRIES = 3
+REMINDER_RETRY_DELAY = 60
+
+
+def _deliver(task, appointment_ids):
+    """Send the reminders, retrying only the ones that failed."""
+    failed = deliver_reminders(appointment_ids)
+    if failed:
+        try:
+            raise task.retry(args=[failed])
+        except MaxRetriesExceededError:
+            return f"Sent {len(appointment_ids) - len(failed)} reminders, {len(failed)} failed"
+    return f"Sent {len(appointment_ids)} reminders"
+
+
+@shared_task(bind=True, max_retries=REMINDER_MAX_RETRIES, default_retry_delay=REMINDER_RETRY_DELAY)
+def send_appointment_reminders(self, appointment_ids):
+    """Send the reminders of many appointments over one mail connection"""
+    return _deliver(self, appointment_ids)
+
+
+@shared_task(bind=True, max_retries=REMINDER_MAX_RETRIES, default_retry_delay=REMINDER_RETRY_DELAY)
+def send_appointment_reminder(self, appointment_id):
     """Send reminder for a specific appointment"""
-    try:
-        appointment = Appointment.objects.get(id=appointment_id)
-        patient = appointment.patient
-        doctor = appointment.doctor
-        
-        subject = f"Appointment Reminder: {appointment.date.strftime('%Y-%m-%d %H:%M')}"
-        message = f"""
-        Hello {patient.name},
-        
-        This is a reminder for your appointment with Dr. {doctor.name}
-        on {appointment.date.strftime('%A, %B %d, %Y at %I:%M %p')}.
-        
-        Please arrive 15 minutes early.
-        
-        Thank you,
-        {settings.SITE_NAME}
-        """
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [patient.email],
-            fail_silently=False,
-        )
-        
-        print(f"Reminder sent for appointment {appointment_id}")
-        
-    except Appointment.DoesNotExist:
-        print(f"Appointment {appointment_id} not found")
+    return _deliver(self, [appointment_id])
 
 @shared_task
 def check_upcoming_appointments():
-    """Check for appointments happening soon and send reminders"""
-    now = timezone.now()
-    reminder_time = now + timedelta(hours=24)  # 24 hours from now
-    
-    # Find appointments happening in the next 24 hours
-    upcoming_appointments = Appointment.objects.filter(
-        date__gte=now,
-        date__lte=reminder_time,
-        status='scheduled',
-        reminder_sent=False
-    )
-    
-    for appointment in upcoming_appointments:
-        # Send reminder
-        send_appointment_reminder.delay(appointment.id)
-        # Mark as reminder sent
-        appointment.reminder_sent = True
-        appointment.save()
-    
-    return f"Checked {upcoming_appointments.count()} appointments"
\ No newline at end of file
+    """
+    Send the reminders that are due (remind_at has passed; see
+    reminders.due_reminders). Runs every minute from beat, so this is the
+    only path a reminder takes and booking never waits on the broker:
+    claim them in batches (each marked as sent with one UPDATE) and queue
+    every batch as one group of send_appointment_reminders tasks, until
+    none are left. Several sweeps may run at once; each reminder is claimed
+    by only one of them. A batch that cannot be queued is released again
+    for the next sweep.
+    """
+    claimed = 0
+    while True:
+        appointment_ids = claim_reminders()
+        if appointment_ids:
+            try:
+                group(
+                    send_appointment_reminders.s(appointment_ids[start:start + REMINDER_SEND_CHUNK])
+                    for start in range(0, len(appointment_ids), REMINDER_SEND_CHUNK)
+                ).apply_async()
+            except Exception:
+                release_reminders(appointment_ids)
+                raise
+            claimed += len(appointment_ids)
+        if len(appointment_ids) < REMINDER_BATCH_SIZE:
+            break
+
+    return f"Queued {claimed} reminders"
+
+@shared_task
+def archive_old_queue_entries():
+    """Nightly rollover: move previous days' queue entries into the archive"""
+    archived = archive_old_entries()
+    return f"Archived {archived} queue entries"
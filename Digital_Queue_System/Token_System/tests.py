@@ -1,3 +1,1661 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import random
+import socketserver
+import threading
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core import mail
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_finished, request_started
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import close_old_connections, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import authentication, events, live_updates, streaming
+from .events import InMemoryBroker, RedisBroker, channel_name
+from .live_updates import QueueEventsRouter
+from .pagination import KeysetPagination
+from .reference_data import ReferenceCache, departments
+from .streaming import stream_json_array
+from .serializers import AppointmentReadSerializer, AppointmentSerializer, QueueReadSerializer, QueueSerializer
+from .archiving import archive_old_entries
+from .history_cache import history_version
+from .models import (
+    Appointment, Department, Diagnosis, Doctor, MedicalNote, MedicalRecord, Patient, Queue, QueueArchive,
+    QueueServiceStats, QueueTokenSequence, Treatment, User
+)
+from .reminders import claim_reminders, deliver_reminders
+from .tasks import check_upcoming_appointments, send_appointment_reminders
+from .queueing import allocate_token, allocate_tokens, claim_next, enqueue, people_ahead, transition_entry
+
+
+def make_patient(number=1):
+    return Patient.objects.create(
+        name=f"Patient {number}",
+        email=f"patient{number}@example.com",
+        date_of_birth=date(1990, 1, 1),
+    )
+
+
+# ------------------------
+# Token Allocator Tests
+# ------------------------
+class TokenAllocatorTests(TestCase):
+    def test_tokens_are_sequential_per_scope(self):
+        self.assertEqual(allocate_token(), 1)
+        self.assertEqual(allocate_token(), 2)
+        self.assertEqual(allocate_token(scope='other'), 1)
+
+    def test_block_allocation_is_contiguous(self):
+        allocate_token()
+        self.assertEqual(list(allocate_tokens(3)), [2, 3, 4])
+        self.assertEqual(allocate_token(), 5)
+
+    def test_sequence_continues_after_existing_entries(self):
+        Queue.objects.create(patient=make_patient(), token_number=7)
+        self.assertEqual(allocate_token(), 8)
+
+    def test_join_queue_uses_sequence(self):
+        client = APIClient()
+        patient = make_patient()
+        first = client.post('/api/queues/join_queue/', {'patient_id': patient.id}, secure=True)
+        second = client.post('/api/queues/join_queue/', {'patient_id': patient.id}, secure=True)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.data['token_details']['token_number'], 1)
+        self.assertEqual(second.data['token_details']['token_number'], 2)
+
+
+class ConcurrentJoinQueueTests(TransactionTestCase):
+    threads = 8
+    joins_per_thread = 10
+
+    def test_concurrent_joins_never_share_a_token(self):
+        patient = make_patient()
+        errors = []
+
+        def kiosk():
+            client = APIClient()
+            try:
+                for _ in range(self.joins_per_thread):
+                    response = client.post('/api/queues/join_queue/', {'patient_id': patient.id}, secure=True)
+                    if response.status_code != 201:
+                        errors.append(response.status_code)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=kiosk) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        total = self.threads * self.joins_per_thread
+        tokens = sorted(Queue.objects.values_list('token_number', flat=True))
+        self.assertEqual(errors, [])
+        self.assertEqual(tokens, list(range(1, total + 1)))
+
+
+# ------------------------
+# Call Next Tests
+# ------------------------
+class CallNextTests(TestCase):
+    def test_call_next_claims_lowest_waiting_token(self):
+        patient = make_patient()
+        for token in (1, 2, 3):
+            Queue.objects.create(patient=patient, token_number=token)
+
+        response = APIClient().post('/api/queues/call_next/', secure=True)
+
+        self.assertEqual(response.data['called_token']['token_number'], 1)
+        self.assertEqual(claim_next().token_number, 2)
+        self.assertEqual(claim_next().token_number, 3)
+        self.assertIsNone(claim_next())
+
+
+# ------------------------
+# Queue Status Tests
+# ------------------------
+class QueueStatusTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        patient = make_patient()
+        self.entries = [Queue.objects.create(patient=patient, token_number=token) for token in (1, 2, 3)]
+
+    def test_transitions_follow_the_state_machine(self):
+        first = self.entries[0]
+        self.assertTrue(transition_entry(first, 'called'))
+        self.assertTrue(transition_entry(first, 'served'))
+        self.assertFalse(transition_entry(first, 'no_show'))
+        first.refresh_from_db()
+        self.assertEqual(first.status, 'served')
+
+    def test_skipped_tokens_leave_the_waiting_line(self):
+        response = self.client.post(f'/api/queues/{self.entries[0].id}/mark_skipped/', secure=True)
+        self.assertEqual(response.data['skipped_token']['status'], 'skipped')
+
+        position = self.client.get(f'/api/queues/{self.entries[2].id}/position/', secure=True)
+        self.assertEqual(position.data['people_ahead'], 1)
+        self.assertEqual(claim_next().token_number, 2)
+
+    def test_finished_token_cannot_be_marked_no_show(self):
+        self.client.post(f'/api/queues/{self.entries[0].id}/mark_served/', secure=True)
+        response = self.client.post(f'/api/queues/{self.entries[0].id}/mark_no_show/', secure=True)
+        self.assertEqual(response.status_code, 400)
+
+    def test_legacy_flags_are_still_serialized(self):
+        response = self.client.post(f'/api/queues/{self.entries[0].id}/mark_served/', secure=True)
+        self.assertTrue(response.data['served_token']['is_called'])
+        self.assertTrue(response.data['served_token']['is_served'])
+
+
+# ------------------------
+# Queue Position Tests
+# ------------------------
+class QueuePositionTests(TestCase):
+    def counted_ahead(self, entry):
+        return Queue.objects.filter(
+            queue_date=entry.queue_date,
+            status='waiting',
+            token_number__lt=entry.token_number
+        ).count()
+
+    def test_watermark_positions_match_counting(self):
+        patient = make_patient()
+        rng = random.Random(5)
+        entries = [enqueue(patient) for _ in range(30)]
+
+        for _ in range(40):
+            action = rng.choice(['call', 'serve', 'skip', 'no_show', 'join'])
+            # Watermarks move once the departure commits
+            with self.captureOnCommitCallbacks(execute=True):
+                if action == 'call':
+                    claim_next()
+                elif action == 'join':
+                    entries.append(enqueue(patient))
+                else:
+                    entry = rng.choice(entries)
+                    entry.refresh_from_db()
+                    transition_entry(entry, {'serve': 'served', 'skip': 'skipped', 'no_show': 'no_show'}[action])
+
+            for entry in entries:
+                entry.refresh_from_db()
+                if entry.status == 'waiting':
+                    self.assertEqual(people_ahead(entry), self.counted_ahead(entry))
+
+    def test_position_endpoint_uses_watermarks(self):
+        patient = make_patient()
+        entries = [enqueue(patient) for _ in range(5)]
+        with self.captureOnCommitCallbacks(execute=True):
+            claim_next()
+            transition_entry(entries[3], 'skipped')
+
+        with self.assertNumQueries(4):
+            response = APIClient().get(f'/api/queues/{entries[4].id}/position/', secure=True)
+
+        self.assertEqual(response.data['people_ahead'], 2)
+
+    def test_failed_watermark_update_is_logged_and_repaired(self):
+        patient = make_patient()
+        entries = [enqueue(patient) for _ in range(4)]
+        with mock.patch('Token_System.queueing._advance_watermark', side_effect=RuntimeError("database is locked")):
+            with self.assertLogs('django.test', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+                called = claim_next()
+        self.assertEqual(called, entries[0])
+
+        self.assertEqual(people_ahead(entries[3]), 2)
+        self.assertEqual(QueueTokenSequence.objects.get(scope='global').called_through, 1)
+
+    def test_deleting_a_waiting_token_moves_the_line_up(self):
+        patient = make_patient()
+        entries = [enqueue(patient) for _ in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            APIClient().delete(f'/api/queues/{entries[0].id}/', secure=True)
+        self.assertEqual(people_ahead(entries[2]), 1)
+
+
+# ------------------------
+# Wait Estimate Tests
+# ------------------------
+class WaitEstimateTests(TestCase):
+    def setUp(self):
+        patient = make_patient()
+        self.entries = [enqueue(patient) for _ in range(6)]
+
+    def serve_after(self, entry, minutes):
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_entry(entry, 'called')
+            Queue.objects.filter(pk=entry.pk).update(called_at=entry.called_at - timedelta(minutes=minutes))
+            entry.refresh_from_db()
+            transition_entry(entry, 'served')
+
+    def test_service_time_is_a_rolling_average(self):
+        self.serve_after(self.entries[0], 5)
+        self.serve_after(self.entries[1], 10)
+
+        stats = QueueServiceStats.objects.get(scope='global')
+        self.assertEqual(stats.served_count, 2)
+        # 300s, then 300 + 0.2 * (600 - 300)
+        self.assertAlmostEqual(stats.avg_service_seconds, 360, delta=1)
+
+        response = APIClient().get(f'/api/queues/{self.entries[5].id}/position/', secure=True)
+        self.assertEqual(response.data['people_ahead'], 3)
+        self.assertEqual(response.data['estimated_wait_minutes'], 18)
+
+    def test_no_estimate_before_anyone_is_served(self):
+        response = APIClient().get(f'/api/queues/{self.entries[2].id}/position/', secure=True)
+        self.assertIsNone(response.data['estimated_wait_minutes'])
+
+    def test_sample_is_recorded_after_the_serve_commits(self):
+        transition_entry(self.entries[0], 'called')
+        with self.captureOnCommitCallbacks() as callbacks:
+            transition_entry(self.entries[0], 'served')
+            self.assertFalse(QueueServiceStats.objects.filter(served_count__gt=0).exists())
+        for callback in callbacks:
+            callback()
+        self.assertEqual(QueueServiceStats.objects.get(scope='global').served_count, 1)
+
+    def test_serving_without_a_call_adds_no_sample(self):
+        transition_entry(self.entries[0], 'served')
+        self.assertIsNotNone(self.entries[0].served_at)
+        self.assertFalse(QueueServiceStats.objects.filter(served_count__gt=0).exists())
+
+
+# ------------------------
+# Queue Partition Tests
+# ------------------------
+class QueuePartitionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.patient = make_patient()
+        self.cardiology = Department.objects.create(name="Cardiology")
+        self.radiology = Department.objects.create(name="Radiology")
+        self.doctor = Doctor.objects.create(name="Ada", specialty="Cardiologist", department=self.cardiology)
+
+    def join(self, **scope):
+        response = self.client.post('/api/queues/join_queue/', {'patient_id': self.patient.id, **scope}, secure=True)
+        return response.data['token_details']
+
+    def test_tokens_are_numbered_per_scope(self):
+        self.assertEqual(self.join(department_id=self.cardiology.id)['token_number'], 1)
+        self.assertEqual(self.join(department_id=self.radiology.id)['token_number'], 1)
+        self.assertEqual(self.join(department_id=self.cardiology.id)['token_number'], 2)
+
+        token = self.join(doctor_id=self.doctor.id)
+        self.assertEqual(token['token_number'], 1)
+        self.assertEqual(token['scope'], f'doctor:{self.doctor.id}')
+        self.assertEqual(token['department'], self.cardiology.id)
+
+    def test_call_next_and_position_stay_within_scope(self):
+        self.join(department_id=self.cardiology.id)
+        radiology_first = self.join(department_id=self.radiology.id)
+        radiology_second = self.join(department_id=self.radiology.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            called = self.client.post('/api/queues/call_next/', {'department_id': self.radiology.id}, secure=True)
+        self.assertEqual(called.data['called_token']['id'], radiology_first['id'])
+
+        position = self.client.get(f"/api/queues/{radiology_second['id']}/position/", secure=True)
+        self.assertEqual(position.data['people_ahead'], 0)
+
+        listed = self.client.get('/api/queues/', {'department_id': self.cardiology.id}, secure=True)
+        self.assertEqual([entry['scope'] for entry in listed.data], [f'department:{self.cardiology.id}'])
+
+    def test_unknown_department_is_rejected(self):
+        response = self.client.post('/api/queues/join_queue/', {'patient_id': self.patient.id, 'department_id': 999}, secure=True)
+        self.assertEqual(response.status_code, 404)
+
+    def test_non_integer_ids_are_rejected(self):
+        for scope in [{'doctor_id': 'abc'}, {'department_id': '1.5'}]:
+            response = self.client.post('/api/queues/join_queue/', {'patient_id': self.patient.id, **scope}, secure=True)
+            self.assertEqual(response.status_code, 400)
+
+
+# ------------------------
+# Bulk Join Tests
+# ------------------------
+class BulkJoinTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.patients = [make_patient(number) for number in range(1, 21)]
+
+    def bulk_join(self, patient_ids, **scope):
+        return self.client.post(
+            '/api/queues/bulk_join/', {'patient_ids': patient_ids, **scope}, format='json', secure=True
+        )
+
+    def test_tokens_are_consecutive_in_request_order(self):
+        self.client.post('/api/queues/join_queue/', {'patient_id': self.patients[0].id}, secure=True)
+        ids = [self.patients[2].id, self.patients[1].id, self.patients[3].id]
+
+        response = self.bulk_join(ids)
+
+        self.assertEqual(response.status_code, 201)
+        tokens = response.data['tokens']
+        self.assertEqual([token['patient'] for token in tokens], ids)
+        self.assertEqual([token['token_number'] for token in tokens], [2, 3, 4])
+        self.assertEqual(people_ahead(Queue.objects.get(id=tokens[-1]['id'])), 3)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        # The first join of the day also creates the sequence row
+        self.bulk_join([self.patients[0].id])
+        with CaptureQueriesContext(connection) as small:
+            self.bulk_join([patient.id for patient in self.patients[1:3]])
+        with CaptureQueriesContext(connection) as large:
+            self.bulk_join([patient.id for patient in self.patients[3:]])
+        self.assertEqual(len(large), len(small))
+
+    def test_unknown_patient_rejects_whole_batch(self):
+        response = self.bulk_join([self.patients[0].id, 999])
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['missing_patient_ids'], [999])
+        self.assertFalse(Queue.objects.exists())
+
+    def test_joins_department_queue(self):
+        department = Department.objects.create(name="Cardiology")
+        response = self.bulk_join([self.patients[0].id], department_id=department.id)
+        self.assertEqual(response.data['tokens'][0]['scope'], f'department:{department.id}')
+
+    def test_invalid_payload_is_rejected(self):
+        self.assertEqual(self.bulk_join([]).status_code, 400)
+        self.assertEqual(self.bulk_join(['abc']).status_code, 400)
+
+
+# ------------------------
+# Queue Archive Tests
+# ------------------------
+class QueueArchiveTests(TestCase):
+    def setUp(self):
+        patient = make_patient()
+        today = date.today()
+        self.yesterday = today - timedelta(days=1)
+        for token in range(1, 6):
+            Queue.objects.create(patient=patient, token_number=token, queue_date=self.yesterday, status='served')
+        self.todays_entry = enqueue(patient)
+        QueueTokenSequence.objects.create(day=self.yesterday, last_token=5)
+
+    def test_old_entries_are_moved_in_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            archived = archive_old_entries(batch_size=2)
+
+        queue_deletes = [q for q in queries.captured_queries if q['sql'].startswith('DELETE FROM "Token_System_queue" ')]
+        self.assertEqual(len(queue_deletes), 3)
+        self.assertEqual(archived, 5)
+        self.assertEqual(list(Queue.objects.all()), [self.todays_entry])
+        self.assertEqual(
+            sorted(QueueArchive.objects.values_list('token_number', flat=True)), [1, 2, 3, 4, 5]
+        )
+        self.assertFalse(QueueTokenSequence.objects.filter(day=self.yesterday).exists())
+
+    def test_reset_queue_and_command_archive(self):
+        response = APIClient().post('/api/queues/reset_queue/', secure=True)
+        self.assertIn("Archived 5", response.data['message'])
+
+        out = StringIO()
+        call_command('archive_queue', stdout=out)
+        self.assertIn("Archived 0", out.getvalue())
+
+
+class ConcurrentCallNextTests(TransactionTestCase):
+    counters = 8
+    waiting = 40
+
+    def test_concurrent_counters_never_call_the_same_token(self):
+        patient = make_patient()
+        for token in range(1, self.waiting + 1):
+            Queue.objects.create(patient=patient, token_number=token)
+        called = []
+
+        def counter():
+            try:
+                while True:
+                    entry = claim_next()
+                    if entry is None:
+                        break
+                    called.append(entry.token_number)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=counter) for _ in range(self.counters)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(called), list(range(1, self.waiting + 1)))
+        self.assertFalse(Queue.objects.filter(status='waiting').exists())
+
+
+# ------------------------
+# Live Update Tests
+# ------------------------
+class InMemoryBrokerTests(SimpleTestCase):
+    def test_subscribers_receive_messages_for_their_channel(self):
+        broker = InMemoryBroker()
+
+        async def scenario():
+            async with broker.subscribe('queue:a') as a, broker.subscribe('queue:b') as b:
+                broker.publish('queue:a', 'hello')
+                return await a.get(timeout=1), await b.get(timeout=0.05)
+
+        self.assertEqual(asyncio.run(scenario()), ('hello', None))
+
+
+class FakePubSub:
+    """The parts of redis.asyncio's PubSub that RedisBroker uses."""
+
+    def __init__(self):
+        self.channels = []
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def unsubscribe(self, channel):
+        self.channels.remove(channel)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class RedisBrokerTests(SimpleTestCase):
+    def test_subscribers_share_one_connection(self):
+        broker = RedisBroker('redis://localhost:6379/1')
+        connections = []
+
+        def connect():
+            connections.append(FakePubSub())
+            return connections[-1]
+
+        broker._connect = connect
+
+        async def scenario():
+            async with broker.subscribe('queue:a') as first, broker.subscribe('queue:a') as second, \
+                    broker.subscribe('queue:b') as other:
+                pubsub = connections[0]
+                self.assertEqual(pubsub.channels, ['queue:a', 'queue:b'])
+                await pubsub.messages.put({'channel': b'queue:a', 'data': b'hello'})
+                received = (await first.get(timeout=1), await second.get(timeout=1), await other.get(timeout=0.05))
+            return received, pubsub.channels
+
+        received, channels_left = asyncio.run(scenario())
+        self.assertEqual(received, ('hello', 'hello', None))
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(channels_left, [])
+
+
+def _http_scope(query_string, headers=()):
+    return {
+        'type': 'http', 'method': 'GET', 'path': '/api/queues/events/',
+        'query_string': query_string, 'headers': list(headers),
+    }
+
+
+class ServerSentEventsTests(SimpleTestCase):
+    def setUp(self):
+        self.broker = InMemoryBroker()
+        events._broker = self.broker
+        patcher = mock.patch.object(
+            live_updates, 'authenticate_token', lambda key: object() if key == 'valid' else None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        events._broker = None
+
+    def _respond(self, scope):
+        sent = []
+
+        async def receive():
+            return {'type': 'websocket.connect'} if scope['type'] == 'websocket' else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(QueueEventsRouter(None)(scope, receive, send))
+        return sent
+
+    def test_stream_requires_a_token(self):
+        for headers, query_string in [((), b'scope=global'), ((), b'scope=global&token=stolen')]:
+            sent = self._respond(_http_scope(query_string, headers))
+            self.assertEqual(sent[0]['status'], 401)
+            self.assertIn((b'www-authenticate', b'Token'), sent[0]['headers'])
+
+    def test_websocket_handshake_requires_a_token(self):
+        sent = self._respond({'type': 'websocket', 'path': '/ws/queues/', 'query_string': b'scope=global'})
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': 4401}])
+
+    def test_events_are_streamed_until_disconnect(self):
+        sent = []
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message.get('body', b'').startswith(b'data:'):
+                disconnect.set()
+
+        async def scenario():
+            scope = _http_scope(b'scope=global', [(b'authorization', b'Token valid')])
+            stream = asyncio.create_task(QueueEventsRouter(None)(scope, receive, send))
+            while not sent:
+                await asyncio.sleep(0.01)
+            self.broker.publish(channel_name('global'), '{"event": "called"}')
+            await asyncio.wait_for(stream, 5)
+
+        asyncio.run(scenario())
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+        self.assertEqual(sent[-1]['body'], b'data: {"event": "called"}\n\n')
+
+
+class QueueEventPublishingTests(TestCase):
+    def test_join_and_call_publish_after_commit(self):
+        published = []
+        patient = make_patient()
+
+        with self.settings(QUEUE_EVENTS_BACKEND='memory'):
+            original_send = events._send
+            events._send = lambda channel, message: published.append((channel, json.loads(message)))
+            try:
+                with self.captureOnCommitCallbacks(execute=True):
+                    APIClient().post('/api/queues/join_queue/', {'patient_id': patient.id}, secure=True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    claim_next()
+            finally:
+                events._send = original_send
+
+        self.assertEqual([message['event'] for _, message in published], ['joined', 'called'])
+        self.assertEqual(published[0][0], 'queue:global')
+        self.assertEqual(published[1][1]['token_number'], 1)
+
+
+# ------------------------
+# Queue Snapshot Tests
+# ------------------------
+class QueueSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # As with CACHE_REDIS_URL set
+        patcher = mock.patch('Token_System.views.cache_is_shared', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.patient = make_patient()
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue(self.patient)
+
+    def test_unchanged_queue_is_served_from_cache(self):
+        first = self.client.get('/api/queues/', secure=True)
+        self.assertEqual(len(first.data), 1)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/queues/', secure=True)
+            not_modified = self.client.get('/api/queues/', HTTP_IF_NONE_MATCH=first['ETag'], secure=True)
+
+        self.assertEqual(cached.data, first.data)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], first['ETag'])
+
+    def test_queue_changes_replace_the_snapshot(self):
+        first = self.client.get('/api/queues/', secure=True)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/queues/join_queue/', {'patient_id': self.patient.id}, secure=True)
+        response = self.client.get('/api/queues/', HTTP_IF_NONE_MATCH=first['ETag'], secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            claim_next()
+        called = self.client.get('/api/queues/', HTTP_IF_NONE_MATCH=response['ETag'], secure=True)
+        self.assertEqual(called.data[0]['status'], 'called')
+
+    def test_process_local_cache_reads_the_database(self):
+        with mock.patch('Token_System.views.cache_is_shared', return_value=False):
+            self.client.get('/api/queues/', secure=True)
+            # Another worker's join: it cannot expire this worker's cache
+            enqueue(self.patient)
+            response = self.client.get('/api/queues/', secure=True)
+        self.assertEqual(len(response.data), 2)
+        self.assertNotIn('ETag', response)
+
+    def test_scoped_snapshots_are_separate(self):
+        department = Department.objects.create(name="Cardiology")
+        scoped = self.client.get('/api/queues/', {'department_id': department.id}, secure=True)
+        self.assertEqual(scoped.data, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue(self.patient, department=department)
+        scoped = self.client.get('/api/queues/', {'department_id': department.id}, secure=True)
+        self.assertEqual(len(scoped.data), 1)
+        self.assertEqual(len(self.client.get('/api/queues/', secure=True).data), 2)
+
+
+# ------------------------
+# Medical History Tests
+# ------------------------
+class PatientMedicalHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # As with CACHE_REDIS_URL set
+        patcher = mock.patch('Token_System.views.cache_is_shared', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="nurse", password="pw", role='staff'))
+        self.patient = make_patient()
+        self.department = Department.objects.create(name="Cardiology")
+        MedicalRecord.objects.create(patient=self.patient, blood_type='O+')
+
+    def add_visits(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._add_visits(count)
+
+    def _add_visits(self, count):
+        for number in range(count):
+            doctor = Doctor.objects.create(name=f"Doctor {number}", specialty="GP", department=self.department)
+            appointment = Appointment.objects.create(patient=self.patient, doctor=doctor, date=timezone.now())
+            Treatment.objects.create(
+                appointment=appointment, treatment_type='medication', name="Rest", description="",
+                start_date=date(2024, 1, 1), prescribed_by=doctor
+            )
+            Diagnosis.objects.create(
+                appointment=appointment, condition="Flu", description="", diagnosed_date=date(2024, 1, 1)
+            )
+            MedicalNote.objects.create(
+                appointment=appointment, note_type='progress', title="Visit", content="", created_by=doctor
+            )
+
+    def get_history(self):
+        return self.client.get(f'/api/patients/{self.patient.id}/medical-history/', secure=True)
+
+    def test_process_local_cache_reads_the_database(self):
+        with mock.patch('Token_System.views.cache_is_shared', return_value=False):
+            self.get_history()
+            # As from another process, e.g. a reminder claimed by the Celery
+            # worker: this one's cache is not expired
+            self._add_visits(1)
+            self.assertEqual(len(self.get_history().data['appointments']), 1)
+
+    def test_query_count_does_not_grow_with_history(self):
+        # Patient with record, then appointments, treatments, diagnoses and notes
+        self.add_visits(1)
+        with self.assertNumQueries(5):
+            self.get_history()
+
+        self.add_visits(20)
+        with self.assertNumQueries(5):
+            response = self.get_history()
+
+        self.assertEqual(len(response.data['treatments']), 21)
+        self.assertEqual(response.data['treatments'][-1]['prescribed_by_name'], "Doctor 19")
+        self.assertEqual(response.data['medical_notes'][0]['created_by_name'], "Doctor 0")
+        self.assertEqual(response.data['medical_record']['patient_name'], self.patient.name)
+
+    def test_patient_without_medical_record(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MedicalRecord.objects.filter(patient=self.patient).delete()
+        with self.assertNumQueries(5):
+            response = self.get_history()
+        self.assertIsNone(response.data['medical_record'])
+
+    def test_repeat_views_are_served_from_the_cache(self):
+        self.add_visits(2)
+        first = self.get_history()
+        with self.assertNumQueries(0):
+            again = self.get_history()
+        self.assertEqual(again.data, first.data)
+
+    def test_changes_to_the_history_invalidate_it(self):
+        self.add_visits(1)
+        self.get_history()
+
+        treatment = Treatment.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            treatment.name = "Fluids"
+            treatment.save()
+        self.assertEqual(self.get_history().data['treatments'][0]['name'], "Fluids")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            doctor = Doctor.objects.get(pk=treatment.prescribed_by_id)
+            doctor.name = "Dr. Renamed"
+            doctor.save()
+        self.assertEqual(self.get_history().data['treatments'][0]['prescribed_by_name'], "Dr. Renamed")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Diagnosis.objects.get().delete()
+        self.assertEqual(self.get_history().data['diagnoses'], [])
+
+    def test_moving_a_record_invalidates_both_patients(self):
+        self.add_visits(1)
+        other = make_patient(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            visit = Appointment.objects.create(patient=other, doctor=Doctor.objects.get(), date=timezone.now())
+        self.get_history()
+        other_history = f'/api/patients/{other.id}/medical-history/'
+        self.assertEqual(self.client.get(other_history, secure=True).data['medical_notes'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            note = MedicalNote.objects.get()
+            note.appointment = visit
+            note.save()
+        self.assertEqual(self.get_history().data['medical_notes'], [])
+        self.assertEqual(len(self.client.get(other_history, secure=True).data['medical_notes']), 1)
+
+
+# ------------------------
+# Pagination Tests
+# ------------------------
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        patient = make_patient()
+        doctor = Doctor.objects.create(name="Ada", specialty="GP", department=Department.objects.create(name="GP"))
+        start = timezone.now()
+        self.appointments = [
+            Appointment.objects.create(patient=patient, doctor=doctor, date=start + timedelta(hours=hour % 3))
+            for hour in range(7)
+        ]
+
+    def test_cursor_walks_every_appointment_once_newest_first(self):
+        response = self.client.get('/api/appointments/', {'page_size': 3}, secure=True)
+        self.assertIsNone(response.data['previous'])
+
+        seen = []
+        while True:
+            seen.extend(response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'], secure=True)
+
+        self.assertEqual(sorted(item['id'] for item in seen), sorted(a.id for a in self.appointments))
+        dates = [item['date'] for item in seen]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_page_size_is_capped(self):
+        first = self.appointments[0]
+        Appointment.objects.bulk_create(
+            Appointment(patient=first.patient, doctor=first.doctor, date=first.date) for _ in range(200)
+        )
+        response = self.client.get('/api/appointments/', {'page_size': 10000}, secure=True)
+        self.assertEqual(len(response.data['results']), KeysetPagination.max_page_size)
+
+    def test_queue_list_is_not_paginated(self):
+        cache.clear()
+        enqueue(make_patient(2))
+        response = self.client.get('/api/queues/', secure=True)
+        self.assertIsInstance(response.data, list)
+
+
+# ------------------------
+# Read Serializer Tests
+# ------------------------
+class ValuesReadSerializerTests(TestCase):
+    def setUp(self):
+        self.patient = make_patient()
+        self.doctor = Doctor.objects.create(name="Ada", specialty="GP", department=Department.objects.create(name="GP"))
+
+    def test_appointment_output_matches_model_serializer(self):
+        for hours in range(3):
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=timezone.now() + timedelta(hours=hours))
+        appointments = Appointment.objects.order_by('id')
+
+        fast = AppointmentReadSerializer.to_representation(AppointmentReadSerializer.values(appointments))
+
+        self.assertEqual(json.dumps(fast), json.dumps(AppointmentSerializer(appointments, many=True).data))
+
+    def test_queue_output_matches_model_serializer(self):
+        entries = [enqueue(self.patient) for _ in range(3)]
+        transition_entry(entries[0], 'called')
+        transition_entry(entries[0], 'served')
+        queue = Queue.objects.order_by('id')
+
+        fast = QueueReadSerializer.to_representation(QueueReadSerializer.values(queue))
+
+        self.assertEqual(json.dumps(fast), json.dumps(QueueSerializer(queue, many=True).data))
+
+    def test_list_endpoint_pages_with_client_ordering(self):
+        other = make_patient(2)
+        for patient in (self.patient, other, self.patient):
+            Appointment.objects.create(patient=patient, doctor=self.doctor, date=timezone.now())
+
+        response = APIClient().get('/api/appointments/', {'ordering': 'patient', 'page_size': 2}, secure=True)
+        following = APIClient().get(response.data['next'], secure=True)
+
+        patients = [item['patient'] for item in response.data['results'] + following.data['results']]
+        self.assertEqual(patients, [self.patient.id, self.patient.id, other.id])
+
+
+# ------------------------
+# Streaming Export Tests
+# ------------------------
+class StreamingExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = User.objects.create_user(username="clerk", password="pw", role='staff')
+        self.client.force_authenticate(self.staff)
+        patient = make_patient()
+        doctor = Doctor.objects.create(name="Ada", specialty="GP", department=Department.objects.create(name="GP"))
+        for hours in range(5):
+            Appointment.objects.create(patient=patient, doctor=doctor, date=timezone.now() + timedelta(hours=hours))
+
+    def test_appointments_stream_as_one_json_array(self):
+        response = self.client.get('/api/appointments/export/', secure=True)
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        exported = json.loads(b''.join(response.streaming_content))
+        listed = self.client.get('/api/appointments/', secure=True).data['results']
+        self.assertEqual(exported, listed)
+
+    def test_rows_are_encoded_chunk_by_chunk(self):
+        chunks = list(stream_json_array(Appointment.objects.order_by('id'), AppointmentReadSerializer, chunk_size=2))
+        self.assertEqual(len(chunks), 5)  # bracket, three chunks, bracket
+        self.assertEqual(len(json.loads(b''.join(chunks))), 5)
+
+    def test_standard_json_fallback_matches(self):
+        data = AppointmentReadSerializer.to_representation(AppointmentReadSerializer.values(Appointment.objects.all()))
+        original = streaming.orjson
+        streaming.orjson = None
+        try:
+            fallback = streaming.dumps(data)
+        finally:
+            streaming.orjson = original
+        self.assertEqual(json.loads(fallback), json.loads(streaming.dumps(data)))
+
+    def test_empty_export_is_an_empty_array(self):
+        response = self.client.get('/api/users/export/', {'role': 'patient'}, secure=True)
+        self.assertEqual(b''.join(response.streaming_content), b'[]')
+
+    def test_asgi_export_is_sent_chunk_by_chunk(self):
+        token = Token.objects.create(user=self.staff)
+        fetched = []
+        original = streaming.serialized_chunks
+
+        def counted_chunks(queryset, read_serializer, chunk_size, fields):
+            for chunk in original(queryset, read_serializer, 2, fields):
+                fetched.append(chunk)
+                yield chunk
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/api/appointments/export/', 'query_string': b'output=ndjson',
+            'scheme': 'https', 'server': ('testserver', 443),
+            'headers': [(b'host', b'testserver'), (b'authorization', f"Token {token.key}".encode())],
+        }
+        bodies = []
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # The client stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                self.assertEqual(message['status'], 200)
+            elif message.get('body'):
+                bodies.append((message['body'], len(fetched)))
+
+        # As the test client does, so the test's transaction stays open
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        with mock.patch.object(streaming, 'serialized_chunks', counted_chunks):
+            # Run from this thread so the view shares the test's connection
+            async_to_sync(ASGIHandler())(scope, receive, send)
+
+        self.assertEqual(len(fetched), 3)
+        self.assertEqual([chunk_count for _, chunk_count in bodies], [1, 2, 3])
+        self.assertEqual(sum(body.count(b'\n') for body, _ in bodies), 5)
+
+    def test_exports_need_an_allowed_role(self):
+        self.client.force_authenticate(None)
+        for path in ['/api/users/export/', '/api/appointments/export/']:
+            self.assertEqual(self.client.get(path, {'output': 'csv'}, secure=True).status_code, 401)
+
+        patient = User.objects.create_user(
+            username="pat", password="pw", role='patient', date_of_birth=date(1990, 1, 1)
+        )
+        doctor = User.objects.create_user(username="doc", password="pw", role='doctor')
+        self.client.force_authenticate(patient)
+        self.assertEqual(self.client.get('/api/users/export/', secure=True).status_code, 403)
+        self.assertEqual(self.client.get('/api/appointments/export/', secure=True).status_code, 403)
+        self.client.force_authenticate(doctor)
+        self.assertEqual(self.client.get('/api/users/export/', secure=True).status_code, 403)
+        self.assertEqual(self.client.get('/api/appointments/export/', secure=True).status_code, 200)
+
+
+# ------------------------
+# Sparse Fieldset Tests
+# ------------------------
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.department = Department.objects.create(name="Cardiology", description="Hearts")
+        self.doctors = [
+            Doctor.objects.create(name=f"Doctor {number}", specialty="GP", department=self.department)
+            for number in range(3)
+        ]
+        self.patient = make_patient()
+
+    def test_doctor_department_is_only_nested_on_request(self):
+        plain = self.client.get('/api/doctors/', secure=True).data['results']
+        self.assertEqual(plain[0]['department'], self.department.id)
+
+        with self.assertNumQueries(1):
+            expanded = self.client.get('/api/doctors/', {'expand': 'department'}, secure=True).data['results']
+        self.assertEqual(expanded[0]['department']['description'], "Hearts")
+
+    def test_fields_narrow_output_and_columns(self):
+        doctor = self.doctors[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/doctors/{doctor.id}/', {'fields': 'id,name'}, secure=True)
+        self.assertEqual(response.data, {'id': doctor.id, 'name': doctor.name})
+        self.assertNotIn('specialty', queries[0]['sql'])
+
+    def test_fast_list_path_honours_fields(self):
+        Appointment.objects.create(patient=self.patient, doctor=self.doctors[0], date=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/appointments/', {'fields': 'id,status'}, secure=True)
+        self.assertEqual(list(response.data['results'][0]), ['id', 'status'])
+        self.assertNotIn('reminder_sent', queries[0]['sql'])
+
+        enqueue(self.patient)
+        queue = self.client.get('/api/queues/', {'fields': 'token_number,is_called'}, secure=True)
+        self.assertEqual(queue.data, [{'token_number': 1, 'is_called': False}])
+
+    def test_writes_ignore_the_parameters(self):
+        response = self.client.post(
+            '/api/appointments/?fields=id',
+            {'patient': self.patient.id, 'doctor': self.doctors[0].id, 'date': timezone.now().isoformat()},
+            format='json', secure=True
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['patient'], self.patient.id)
+
+        doctor = self.client.post(
+            '/api/doctors/', {'name': "Grace", 'specialty': "GP", 'department_id': self.department.id},
+            format='json', secure=True
+        )
+        self.assertEqual(doctor.data['department'], self.department.id)
+
+
+# ------------------------
+# Record Export Tests
+# ------------------------
+class RecordExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="clerk", password="pw", role='staff'))
+        patient = make_patient()
+        self.cardiology = Department.objects.create(name="Cardiology")
+        radiology = Department.objects.create(name="Radiology")
+        self.cardiologist = Doctor.objects.create(name="Ada", specialty="Cardiologist", department=self.cardiology)
+        radiologist = Doctor.objects.create(name="Grace", specialty="Radiologist", department=radiology)
+        for day, doctor in ((1, self.cardiologist), (15, self.cardiologist), (15, radiologist), (40, self.cardiologist)):
+            when = timezone.make_aware(datetime(2024, 1, 1) + timedelta(days=day - 1, hours=9))
+            appointment = Appointment.objects.create(patient=patient, doctor=doctor, date=when)
+            Treatment.objects.create(
+                appointment=appointment, treatment_type='medication', name="Rest", description="",
+                start_date=when.date(), prescribed_by=doctor
+            )
+
+    def test_csv_export_filters_by_date_range_and_department(self):
+        response = self.client.get('/api/appointments/export/', {
+            'output': 'csv', 'date_from': '2024-01-01', 'date_to': '2024-01-31', 'department_id': self.cardiology.id,
+        }, secure=True)
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('appointments.csv', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row['doctor'] for row in rows}, {str(self.cardiologist.id)})
+
+    def test_ndjson_treatment_export(self):
+        response = self.client.get('/api/treatments/export/', {'output': 'ndjson', 'date_to': '2024-01-15'}, secure=True)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['prescribed_by_name'], "Ada")
+
+    def test_bad_parameters_are_rejected(self):
+        self.assertEqual(self.client.get('/api/appointments/export/', {'output': 'xml'}, secure=True).status_code, 400)
+        self.assertEqual(self.client.get('/api/diagnoses/export/', {'date_from': 'soon'}, secure=True).status_code, 400)
+
+    def test_empty_csv_export_has_a_header(self):
+        response = self.client.get('/api/medical-notes/export/', {'output': 'csv'}, secure=True)
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines()[0].split(',')[0], 'id')
+
+    def test_management_command_streams_in_chunks(self):
+        out = StringIO()
+        call_command(
+            'export_records', 'treatments', '--output', 'ndjson', '--from', '2024-01-15',
+            '--department', str(self.cardiology.id), '--chunk-size', '1', stdout=out
+        )
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['start_date'] for row in rows], ['2024-01-15', '2024-02-09'])
+
+
+# ------------------------
+# Bulk Appointment Tests
+# ------------------------
+class BulkAppointmentTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        department = Department.objects.create(name="GP")
+        self.doctors = [
+            Doctor.objects.create(name=f"Doctor {number}", specialty="GP", department=department)
+            for number in range(3)
+        ]
+        self.patients = [make_patient(number) for number in range(3)]
+
+    def _items(self, count):
+        return [
+            {
+                'patient': self.patients[number % 3].id,
+                'doctor': self.doctors[number % 3].id,
+                'date': (timezone.now() + timedelta(days=number)).isoformat(),
+            }
+            for number in range(count)
+        ]
+
+    def test_create_uses_a_fixed_number_of_queries(self):
+        query_counts = []
+        for count in (2, 20):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    '/api/appointments/bulk_create/', self._items(count), format='json', secure=True
+                )
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.data), count)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(Appointment.objects.count(), 22)
+        self.assertFalse(Appointment.objects.filter(remind_at__isnull=True).exists())
+
+    def test_invalid_items_are_reported_and_nothing_is_saved(self):
+        items = self._items(3)
+        items[1]['doctor'] = 999999
+        items[2]['status'] = 'maybe'
+        response = self.client.post(
+            '/api/appointments/bulk_create/', {'appointments': items}, format='json', secure=True
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([item['index'] for item in response.data['items']], [1, 2])
+        self.assertIn('doctor', response.data['items'][0]['errors'])
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_bulk_update_changes_only_the_given_fields(self):
+        created = self.client.post(
+            '/api/appointments/bulk_create/', self._items(4), format='json', secure=True
+        ).data
+        changes = [{'id': item['id'], 'status': 'completed'} for item in created]
+        changes[0]['doctor'] = self.doctors[2].id
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch('/api/appointments/bulk_update/', changes, format='json', secure=True)
+
+        self.assertEqual(response.status_code, 200)
+        # One UPDATE per set of fields sent: the doctor column is written
+        # for the first appointment only
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(sum('"doctor_id" = CASE' in sql for sql in updates), 1)
+        self.assertEqual(len(queries), 6)  # savepoint, appointments, patients, doctors, updates
+        self.assertEqual(set(Appointment.objects.values_list('status', flat=True)), {'completed'})
+        first = Appointment.objects.get(id=created[0]['id'])
+        self.assertEqual(first.doctor_id, self.doctors[2].id)
+        self.assertEqual(first.patient_id, created[0]['patient'])
+
+    def test_bulk_update_rejects_unknown_ids(self):
+        response = self.client.patch(
+            '/api/appointments/bulk_update/', [{'id': 424242, 'status': 'canceled'}], format='json', secure=True
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'][0]['index'], 0)
+
+
+# ------------------------
+# Reference Data Tests
+# ------------------------
+class ReferenceDataTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.department = Department.objects.create(name="Cardiology")
+            Doctor.objects.create(name="Ada", specialty="Cardiologist", department=self.department)
+
+    def test_lists_are_served_from_memory(self):
+        first = self.client.get('/api/doctors/', secure=True)
+        with self.assertNumQueries(0):
+            again = self.client.get('/api/doctors/', secure=True)
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(again.data['results'][0]['department'], self.department.id)
+
+    def test_writes_are_seen_after_commit(self):
+        self.client.get('/api/departments/', secure=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                f'/api/departments/{self.department.id}/', {'name': "Heart Centre"}, format='json', secure=True
+            )
+        self.assertEqual(self.client.get('/api/departments/', secure=True).data['results'][0]['name'], "Heart Centre")
+
+    def test_other_workers_reload_when_the_generation_moves(self):
+        other_worker = ReferenceCache('departments', Department.objects.all())
+        self.assertEqual(len(other_worker.all()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Department.objects.create(name="Radiology")
+        with self.assertNumQueries(1):
+            self.assertEqual(len(other_worker.all()), 2)
+
+    def test_doctor_validation_uses_the_cached_department(self):
+        departments.all()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/doctors/', {'name': "Grace", 'specialty': "GP", 'department_id': self.department.id},
+                format='json', secure=True
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([query for query in queries if 'SELECT' in query['sql'] and 'department' in query['sql']])
+
+    def test_rows_not_yet_cached_are_found_in_the_database(self):
+        departments.all()
+        new = Department.objects.create(name="Radiology")  # not committed, so not invalidated
+        self.assertEqual(departments.get(new.id), new)
+
+
+# ------------------------
+# Medical Record Conditional Request Tests
+# ------------------------
+class MedicalRecordConditionalTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username="doc", password="pw", role='staff'))
+        self.patient = make_patient()
+        self.record = MedicalRecord.objects.create(patient=self.patient, blood_type='O+')
+        self.url = f'/api/medical-records/{self.record.id}/'
+
+    def test_unchanged_record_is_answered_with_304(self):
+        response = self.client.get(self.url, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            again = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'], secure=True)
+        self.assertEqual(again.status_code, 304)
+        since = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'], secure=True)
+        self.assertEqual(since.status_code, 304)
+
+        patient_view = f'/api/patients/{self.patient.id}/medical-record/'
+        self.assertEqual(self.client.get(patient_view, secure=True)['ETag'], response['ETag'])
+        with self.assertNumQueries(1):
+            cached = self.client.get(patient_view, HTTP_IF_NONE_MATCH=response['ETag'], secure=True)
+        self.assertEqual(cached.status_code, 304)
+
+    def test_sparse_and_full_responses_have_different_etags(self):
+        sparse = self.client.get(self.url, {'fields': 'id'}, secure=True)
+        full = self.client.get(self.url, HTTP_IF_NONE_MATCH=sparse['ETag'], secure=True)
+        self.assertEqual(full.status_code, 200)
+        self.assertIn('blood_type', full.data)
+        self.assertNotEqual(full['ETag'], sparse['ETag'])
+
+        same = self.client.get(self.url, {'fields': ' id,'}, HTTP_IF_NONE_MATCH=sparse['ETag'], secure=True)
+        self.assertEqual(same.status_code, 304)
+        # Either copy is good for If-Match
+        updated = self.client.patch(
+            self.url, {'notes': "Seen"}, format='json', HTTP_IF_MATCH=sparse['ETag'], secure=True
+        )
+        self.assertEqual(updated.status_code, 200)
+
+    def test_changed_record_is_sent_again(self):
+        etag = self.client.get(self.url, secure=True)['ETag']
+        self.record.allergies = "Penicillin"
+        self.record.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['allergies'], "Penicillin")
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_match_prevents_lost_updates(self):
+        etag = self.client.get(self.url, secure=True)['ETag']
+        updated = self.client.patch(
+            self.url, {'notes': "First"}, format='json', HTTP_IF_MATCH=etag, secure=True
+        )
+        self.assertEqual(updated.status_code, 200)
+        self.assertNotEqual(updated['ETag'], etag)
+
+        stale = self.client.patch(
+            self.url, {'notes': "Second"}, format='json', HTTP_IF_MATCH=etag, secure=True
+        )
+        self.assertEqual(stale.status_code, 412)
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.notes, "First")
+
+
+# ------------------------
+# Cached Token Authentication Tests
+# ------------------------
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        # As with CACHE_REDIS_URL set
+        patcher = mock.patch.object(authentication, 'cache_is_shared', lambda: True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="pat", password="old-pw", role='patient', date_of_birth=date(1990, 1, 1)
+        )
+        response = self.client.post('/api/auth/login/', {'username': "pat", 'password': "old-pw"}, secure=True)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {response.data['token']}")
+
+    def test_repeat_requests_need_no_auth_queries(self):
+        record = MedicalRecord.objects.create(patient=self.user.patient_profile, blood_type='A+')
+        self.client.get('/api/medical-records/', secure=True)
+
+        # The records and their patient's name; the user and their patient
+        # profile come from the cache
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/medical-records/', secure=True)
+        self.assertEqual([item['id'] for item in response.data['results']], [record.id])
+
+    def test_logout_revokes_the_cached_token(self):
+        self.assertEqual(self.client.get('/api/profile/', secure=True).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/auth/logout/', secure=True).status_code, 200)
+        self.assertEqual(self.client.get('/api/profile/', secure=True).status_code, 401)
+
+    def test_password_and_role_changes_are_picked_up(self):
+        self.client.get('/api/profile/', secure=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/profile/change-password/', {'old_password': "old-pw", 'new_password': "new-pw"}, secure=True
+            )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password("new-pw"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.filter(pk=self.user.pk).update(role='staff')
+            self.user.refresh_from_db()
+            self.user.save()
+        self.assertEqual(self.client.get('/api/profile/', secure=True).data['role'], 'staff')
+
+    def test_principal_loaded_before_a_change_is_not_served_after_it(self):
+        cache.clear()
+        load = authentication._principal
+
+        def load_then_change(user, generation):
+            principal = load(user, generation)
+            # The role changes and its invalidation runs before this request
+            # caches what it read
+            User.objects.filter(pk=user.pk).update(role='staff')
+            authentication.forget_user_tokens(user.pk)
+            return principal
+
+        with mock.patch.object(authentication, '_principal', side_effect=load_then_change):
+            self.assertEqual(self.client.get('/api/profile/', secure=True).data['role'], 'patient')
+        self.assertEqual(self.client.get('/api/profile/', secure=True).data['role'], 'staff')
+
+    def test_process_local_cache_checks_every_request(self):
+        with mock.patch.object(authentication, 'cache_is_shared', lambda: False):
+            self.client.get('/api/profile/', secure=True)
+            # No revocation marker is left (on_commit callbacks do not run
+            # here), as with a logout through another worker
+            Token.objects.filter(user=self.user).delete()
+            self.assertEqual(self.client.get('/api/profile/', secure=True).status_code, 401)
+
+    def test_profile_update_keeps_the_password(self):
+        self.client.get('/api/profile/', secure=True)
+        response = self.client.patch('/api/profile/', {'first_name': "Pat"}, format='json', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, "Pat")
+        self.assertTrue(self.user.check_password("old-pw"))
+
+
+# ------------------------
+# Patient Profile Sync Tests
+# ------------------------
+class PatientProfileSyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="pat", email="pat@example.com", password="pw", role='patient', date_of_birth=date(1990, 1, 1)
+        )
+
+    def patient_updates(self, queries):
+        return [query['sql'] for query in queries if query['sql'].startswith('UPDATE "Token_System_patient"')]
+
+    def test_creating_a_patient_writes_the_profile_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            User.objects.create_user(
+                username="new", email="new@example.com", password="pw", role='patient', date_of_birth=date(1990, 1, 1)
+            )
+        self.assertEqual(self.patient_updates(queries), [])
+        self.assertEqual(Patient.objects.get(user__username="new").email, "new@example.com")
+
+    def test_login_does_not_touch_the_profile(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username="pat", password="pw"))
+        self.assertEqual(self.patient_updates(queries), [])
+
+        user = User.objects.get(pk=self.user.pk)
+        with CaptureQueriesContext(connection) as queries:
+            user.first_name = "Pat"
+            user.save()
+        self.assertEqual(self.patient_updates(queries), [])
+
+    def test_changed_fields_are_copied_alone(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.email = "new@example.com"
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        updates = self.patient_updates(queries)
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"name"', updates[0])
+        self.assertEqual(Patient.objects.get(user=user).email, "new@example.com")
+
+        # Saving again without changes writes nothing more
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(self.patient_updates(queries), [])
+
+    def test_unsaved_changes_survive_a_partial_save(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.username = "patricia"
+        user.save(update_fields=['last_login'])
+        self.assertEqual(Patient.objects.get(user=user).name, "pat")
+        user.save()
+        self.assertEqual(Patient.objects.get(user=user).name, "patricia")
+
+
+# ------------------------
+# Reminder Sweep Tests
+# ------------------------
+def make_appointments(count, hours_ahead=2, **fields):
+    patient = Patient.objects.first() or make_patient()
+    doctor = Doctor.objects.first() or Doctor.objects.create(
+        name="Ada", specialty="GP", department=Department.objects.create(name="GP")
+    )
+    when = timezone.now() + timedelta(hours=hours_ahead)
+    appointments = [Appointment(patient=patient, doctor=doctor, date=when, **fields) for _ in range(count)]
+    for appointment in appointments:
+        # Set by save(), which bulk_create skips
+        appointment.remind_at = appointment.compute_remind_at()
+    return Appointment.objects.bulk_create(appointments)
+
+
+class ReminderSweepTests(TestCase):
+    def setUp(self):
+        self.due = make_appointments(7)
+        make_appointments(1, hours_ahead=30)
+        make_appointments(1, status='canceled')
+        make_appointments(1, reminder_sent=True)
+
+    def test_claims_bounded_batches_until_none_are_left(self):
+        batches = []
+        while True:
+            claimed = claim_reminders(batch_size=3)
+            if not claimed:
+                break
+            batches.append(claimed)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual(sorted(sum(batches, [])), sorted(appointment.id for appointment in self.due))
+
+    def test_sweep_sends_each_reminder_once(self):
+        app = check_upcoming_appointments.app
+        app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        try:
+            self.assertEqual(check_upcoming_appointments(), "Queued 7 reminders")
+            self.assertEqual(len(mail.outbox), 7)
+            self.assertEqual(check_upcoming_appointments(), "Queued 0 reminders")
+        finally:
+            app.conf.update(task_always_eager=False, task_eager_propagates=False)
+
+    def test_claims_expire_cached_histories(self):
+        patient_id = self.due[0].patient_id
+        before = history_version(patient_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            claim_reminders()
+        self.assertNotEqual(history_version(patient_id), before)
+
+    def test_batch_that_cannot_be_queued_is_released(self):
+        with mock.patch('Token_System.tasks.group') as group:
+            group.return_value.apply_async.side_effect = ConnectionError("broker down")
+            with self.assertRaises(ConnectionError):
+                check_upcoming_appointments()
+        due_ids = [appointment.id for appointment in self.due]
+        self.assertFalse(Appointment.objects.filter(pk__in=due_ids, reminder_sent=True).exists())
+
+
+class ConcurrentReminderSweepTests(TransactionTestCase):
+    def test_concurrent_sweeps_never_claim_the_same_reminder(self):
+        due = make_appointments(60)
+        claimed = []
+
+        def sweep():
+            try:
+                while True:
+                    batch = claim_reminders(batch_size=4)
+                    if not batch:
+                        break
+                    claimed.extend(batch)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=sweep) for _ in range(6)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(claimed), sorted(appointment.id for appointment in due))
+
+
+# ------------------------
+# Reminder Delivery Tests
+# ------------------------
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib: accepts everything but `server.refuse`,
+    and drops the connection at the first RCPT to an address in
+    `server.hang_up`.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 stand-in")
+        recipients = []
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == 'RCPT':
+                address = command.split(':', 1)[1].strip().strip('<>')
+                if address in server.hang_up:
+                    server.hang_up.discard(address)
+                    return
+                if server.refuse.get(address, 0):
+                    server.refuse[address] -= 1
+                    self.reply("450 mailbox busy")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == 'DATA':
+                self.reply("354 end with .")
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                server.delivered.extend(recipients)
+                recipients = []
+                self.reply("250 queued")
+            elif verb == 'QUIT':
+                self.reply("221 bye")
+                return
+            else:  # EHLO, MAIL, RSET, NOOP
+                if verb in ('MAIL', 'RSET'):
+                    recipients = []
+                self.reply("250 OK")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, refuse=None, hang_up=()):
+        super().__init__(('127.0.0.1', 0), SMTPStandInHandler)
+        self.connections = 0
+        self.delivered = []
+        # address: how many more times it is refused
+        self.refuse = dict(refuse or {})
+        self.hang_up = set(hang_up)
+
+
+class ReminderDeliveryTests(TestCase):
+    def setUp(self):
+        doctor = Doctor.objects.create(name="Ada", specialty="GP", department=Department.objects.create(name="GP"))
+        when = timezone.now() + timedelta(hours=3)
+        self.appointments = [
+            Appointment.objects.create(patient=make_patient(number), doctor=doctor, date=when)
+            for number in range(5)
+        ]
+        self.ids = [appointment.id for appointment in self.appointments]
+
+    def run_smtp(self, refuse=None, hang_up=()):
+        server = SMTPStandIn(refuse, hang_up)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        email_settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=server.server_address[1], EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+        )
+        email_settings.enable()
+        self.addCleanup(email_settings.disable)
+        return server
+
+    def test_batch_is_sent_over_one_connection(self):
+        server = self.run_smtp()
+        with self.assertNumQueries(1):
+            failed = deliver_reminders(self.ids)
+        self.assertEqual(failed, [])
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(sorted(server.delivered), sorted(f"patient{number}@example.com" for number in range(5)))
+
+    def test_refused_recipient_keeps_the_connection(self):
+        server = self.run_smtp(refuse={"patient2@example.com": 1})
+        self.assertEqual(deliver_reminders(self.ids), [self.ids[2]])
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.delivered), 4)
+
+    def test_lost_connection_is_reopened_for_the_rest(self):
+        server = self.run_smtp(hang_up={"patient1@example.com"})
+        self.assertEqual(deliver_reminders(self.ids), [self.ids[1]])
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(len(server.delivered), 4)
+
+    def test_only_failed_messages_are_retried(self):
+        server = self.run_smtp(refuse={"patient2@example.com": 1})
+        result = send_appointment_reminders.apply(args=[self.ids])
+        self.assertEqual(server.delivered.count("patient2@example.com"), 1)
+        self.assertEqual(len(server.delivered), 5)
+        self.assertIn("Sent 1 reminders", result.get())
+
+    def test_gives_up_after_the_last_retry(self):
+        server = self.run_smtp(refuse={"patient4@example.com": 99})
+        result = send_appointment_reminders.apply(args=[self.ids])
+        self.assertEqual(len(server.delivered), 4)
+        self.assertEqual(result.get(), "Sent 0 reminders, 1 failed")
+
+
+# ------------------------
+# Scheduled Reminder Tests
+# ------------------------
+class ScheduledReminderTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.patient = make_patient()
+        self.doctor = Doctor.objects.create(name="Ada", specialty="GP", department=Department.objects.create(name="GP"))
+
+    def book(self, days_ahead=3):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Appointment.objects.create(
+                patient=self.patient, doctor=self.doctor, date=timezone.now() + timedelta(days=days_ahead)
+            )
+
+    def test_booking_sets_remind_at_without_touching_the_broker(self):
+        with mock.patch('celery.app.task.Task.apply_async') as apply_async:
+            appointment = self.book()
+            self.client.post('/api/appointments/bulk_create/', [{
+                'patient': self.patient.id, 'doctor': self.doctor.id, 'date': appointment.date.isoformat(),
+            }], format='json', secure=True)
+        apply_async.assert_not_called()
+        self.assertEqual(appointment.remind_at, appointment.date - timedelta(hours=24))
+
+    def test_moving_a_reminded_appointment_reminds_again(self):
+        appointment = self.book(days_ahead=0.5)
+        self.assertEqual(claim_reminders(), [appointment.id])
+
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        self.assertTrue(appointment.reminder_sent)
+        appointment.date -= timedelta(hours=2)
+        appointment.save(update_fields=['date'])
+        appointment.refresh_from_db()
+        self.assertFalse(appointment.reminder_sent)
+        self.assertEqual(claim_reminders(), [appointment.id])
+
+    def test_bulk_moving_a_reminded_appointment_reminds_again(self):
+        appointment = self.book(days_ahead=0.5)
+        claim_reminders()
+        later = (appointment.date + timedelta(hours=1)).isoformat()
+        self.client.patch(
+            '/api/appointments/bulk_update/', [{'id': appointment.id, 'date': later}], format='json', secure=True
+        )
+        self.assertEqual(claim_reminders(), [appointment.id])
+
+    def test_cancelling_drops_the_reminder(self):
+        appointment = self.book(days_ahead=0.5)
+        appointment.status = 'canceled'
+        appointment.save(update_fields=['status'])
+        self.assertIsNone(Appointment.objects.get(pk=appointment.pk).remind_at)
+        self.assertEqual(claim_reminders(), [])
+
+    def test_unrelated_saves_keep_the_reminder_sent(self):
+        appointment = self.book(days_ahead=0.5)
+        claim_reminders()
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.status = 'scheduled'
+        appointment.save()
+        self.assertTrue(Appointment.objects.get(pk=appointment.pk).reminder_sent)
+
+    def test_sweep_reads_only_due_reminders(self):
+        self.book(days_ahead=3)
+        due = self.book(days_ahead=0.5)
+        self.assertEqual(claim_reminders(), [due.id])
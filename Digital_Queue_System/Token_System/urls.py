@@ -7,7 +7,8 @@ from .views import (
     UserViewSet, DepartmentViewSet, DoctorViewSet,
     PatientViewSet, AppointmentViewSet, QueueViewSet, 
     RegisterView, LoginView, LogoutView, UserProfileView, 
-    ChangePasswordView, MedicalRecordViewSet, PatientMedicalRecordView
+    ChangePasswordView, MedicalRecordViewSet, PatientMedicalRecordView,
+    TreatmentViewSet, DiagnosisViewSet, MedicalNoteViewSet
 )
 
 router = routers.DefaultRouter()
@@ -18,6 +19,9 @@ router.register(r'patients', PatientViewSet)
 router.register(r'appointments', AppointmentViewSet)
 router.register(r'queues', QueueViewSet)
 router.register(r'medical-records', MedicalRecordViewSet)
+router.register(r'treatments', TreatmentViewSet, basename='treatment')
+router.register(r'diagnoses', DiagnosisViewSet, basename='diagnosis')
+router.register(r'medical-notes', MedicalNoteViewSet, basename='medicalnote')
 
 urlpatterns = [
 
@@ -30,9 +34,6 @@ urlpatterns = [
     path('profile/change-password/', ChangePasswordView.as_view(), name='change-password'),
     path('patients/<int:patient_id>/medical-record/', PatientMedicalRecordView.as_view(), name='patient-medical-record'),
     path('patients/<int:patient_id>/medical-history/', PatientMedicalHistoryView.as_view(), name='patient-medical-history'),
-    path('treatments/', include(router.urls)),
-    path('diagnoses/', include(router.urls)),
-    path('medical-notes/', include(router.urls)),
     path("", include(router.urls)),
 ]
 
@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from django.shortcuts import render
 
 # Create your views here.
@@ -5,12 +7,12 @@ from rest_framework import generics
 # from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.response import Response
 from django.utils import timezone
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view
-from datetime import datetime, timedelta
-from django.db.models import Max
+from django.db import transaction
 from django.contrib.auth import authenticate
 from rest_framework.permissions import IsAuthenticated
 from .models import Diagnosis, MedicalNote, Treatment, User
@@ -19,13 +21,29 @@ from .tasks import send_appointment_reminder
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth.forms import PasswordResetForm
 from django.conf import settings
+from django.utils.http import parse_etags
 from .filters import UserFilter
 from django.utils.decorators import method_decorator
 from rest_framework.authtoken.models import Token
 from .models import Department, Doctor, Patient, Appointment, Queue, MedicalRecord
+from .archiving import archive_old_entries
+from .authentication import cache_is_shared
+from .conditional import fails_if_match, is_not_modified, representation, validator_headers
+from .events import publish_queue_event
+from .history_cache import get_history, history_version, invalidate_history
+from .snapshots import ALL_SCOPES, get_snapshot, invalidate_snapshot, snapshot_etag, snapshot_version
+from .queueing import (
+    DEFAULT_SCOPE, claim_next, enqueue, enqueue_many, estimated_wait_minutes, people_ahead, queue_scope,
+    record_departure, transition_entry
+)
+from .read_serializers import FastListMixin
+from .reference_data import ReferenceListMixin, departments, doctors
+from .sparse_fields import SparseFieldsetMixin
+from .streaming import StreamingExportMixin
 from .serializers import (
-    DepartmentSerializer, DiagnosisSerializer, DoctorSerializer, MedicalNoteSerializer, PatientSerializer,
-    AppointmentSerializer, QueueSerializer, TreatmentSerializer, UserSerializer, 
+    AppointmentReadSerializer, DiagnosisReadSerializer, MedicalNoteReadSerializer, QueueReadSerializer,
+    TreatmentReadSerializer, UserReadSerializer, DepartmentSerializer, DiagnosisSerializer, DoctorSerializer, MedicalNoteSerializer, PatientSerializer,
+    AppointmentBulkSerializer, AppointmentSerializer, QueueSerializer, TreatmentSerializer, UserSerializer,
     UserProfileSerializer, MedicalRecordSerializer
 )
 
@@ -42,9 +60,12 @@ class RegisterView(generics.CreateAPIView):
 # --------------------------------------------------
 # User ViewSet, including search fields and filter 
 # --------------------------------------------------
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(StreamingExportMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    read_serializer = UserReadSerializer
+    # Every user's contact details; not for doctors
+    export_roles = ('staff', 'admin')
     filterset_class = UserFilter
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     # Search fields - for general text search
@@ -61,30 +82,174 @@ class UserViewSet(viewsets.ModelViewSet):
 # ------------------------
 # Department ViewSet
 # ------------------------
-class DepartmentViewSet(viewsets.ModelViewSet):
+class DepartmentViewSet(ReferenceListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
+    reference = departments
+    ordering = ['id']
 
 # ------------------------
 #Doctor ViewSet
 # ------------------------
-class DoctorViewSet(viewsets.ModelViewSet):
+class DoctorViewSet(ReferenceListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Doctor.objects.all()
     serializer_class = DoctorSerializer
+    reference = doctors
+    ordering = ['id']
 
 # ------------------------
 #Patient ViewSet
 # ------------------------
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
+    ordering = ['id']
 
 # ------------------------
 # Appointment ViewSet
 # ------------------------
-class AppointmentViewSet(viewsets.ModelViewSet):
+class AppointmentViewSet(FastListMixin, StreamingExportMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Appointment.objects.all()
     serializer_class = AppointmentSerializer
+    read_serializer = AppointmentReadSerializer
+    export_name = 'appointments'
+    # Newest first; backed by the (date, id) index
+    ordering = ['-date', '-id']
+    BULK_LIMIT = 500
+
+    def _bulk_items(self, request):
+        """The list of appointment objects in a bulk request body."""
+        items = request.data
+        if isinstance(items, dict):
+            items = items.get('appointments')
+        if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+            raise ParseError({"error": "Expected a non-empty list of appointments."})
+        if len(items) > self.BULK_LIMIT:
+            raise ParseError({"error": f"At most {self.BULK_LIMIT} appointments can be sent at once."})
+        return items
+
+    def _bulk_context(self, items):
+        """
+        Serializer context with every patient and doctor the batch names,
+        fetched with one query per model.
+        """
+        prefetched = {}
+        for name, model in (('patient', Patient), ('doctor', Doctor)):
+            ids = set()
+            for item in items:
+                try:
+                    ids.add(int(item[name]))
+                except (KeyError, TypeError, ValueError):
+                    pass  # reported by the item's serializer
+            prefetched[model] = model.objects.in_bulk(ids) if ids else {}
+        context = self.get_serializer_context()
+        context['prefetched'] = prefetched
+        return context
+
+    def _invalid_items(self, errors):
+        return Response(
+            {"error": "No appointments were saved; fix the listed items.", "items": errors},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    def _bulk_errors(self, batch):
+        """Per-item validation errors as a 400 response, or None if all are valid."""
+        errors = [
+            {"index": index, "errors": serializer.errors}
+            for index, serializer in enumerate(batch)
+            if not serializer.is_valid()
+        ]
+        return self._invalid_items(errors) if errors else None
+
+    @action(detail=False, methods=['post'])
+    def bulk_create(self, request):
+        """
+        Create a batch of appointments. Every item is validated first and
+        nothing is saved unless all of them are valid.
+        """
+        items = self._bulk_items(request)
+        context = self._bulk_context(items)
+        batch = [AppointmentBulkSerializer(data=item, context=context) for item in items]
+        errors = self._bulk_errors(batch)
+        if errors:
+            return errors
+
+        appointments = [Appointment(**serializer.validated_data) for serializer in batch]
+        for appointment in appointments:
+            # Set by save(), which bulk_create skips
+            appointment.remind_at = appointment.compute_remind_at()
+        with transaction.atomic():
+            appointments = Appointment.objects.bulk_create(appointments)
+            # bulk_create sends no signals
+            patient_ids = [appointment.patient_id for appointment in appointments]
+            transaction.on_commit(lambda: invalidate_history(*patient_ids))
+        return Response(AppointmentSerializer(appointments, many=True).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['patch'])
+    def bulk_update(self, request):
+        """
+        Partially update a batch of appointments, each item naming its 'id'.
+        Nothing is saved unless every item is valid.
+        """
+        items = self._bulk_items(request)
+        ids = []
+        for index, item in enumerate(items):
+            try:
+                ids.append(int(item['id']))
+            except (KeyError, TypeError, ValueError):
+                raise ParseError({"error": f"Item {index} needs an integer 'id'."})
+        if len(set(ids)) != len(ids):
+            raise ParseError({"error": "Each appointment can appear only once."})
+
+        with transaction.atomic():
+            # Locked (in id order) until the batch is written, so an edit
+            # made meanwhile is neither lost nor overwritten with stale values
+            appointments = self.get_queryset().select_for_update().order_by('pk').in_bulk(ids)
+            missing = [
+                {"index": index, "errors": {"id": [f"Appointment {appointment_id} not found."]}}
+                for index, appointment_id in enumerate(ids)
+                if appointment_id not in appointments
+            ]
+            if missing:
+                return self._invalid_items(missing)
+
+            context = self._bulk_context(items)
+            batch = [
+                AppointmentBulkSerializer(
+                    appointments[appointment_id],
+                    data={name: value for name, value in item.items() if name != 'id'},
+                    partial=True, context=context,
+                )
+                for appointment_id, item in zip(ids, items)
+            ]
+            errors = self._bulk_errors(batch)
+            if errors:
+                return errors
+
+            # Both the previous and the new patient's history change
+            patient_ids = [serializer.instance.patient_id for serializer in batch]
+            # Each row writes only the fields its item sent, one
+            # bulk_update per distinct set of fields
+            by_fields = defaultdict(list)
+            for serializer in batch:
+                appointment = serializer.instance
+                changed = set(serializer.validated_data)
+                for name, value in serializer.validated_data.items():
+                    setattr(appointment, name, value)
+                if changed & {'date', 'status'}:
+                    # As save() would
+                    changed.update(['remind_at', 'reminder_sent'])
+                    appointment.reschedule_reminder()
+                if changed:
+                    by_fields[tuple(sorted(changed))].append(appointment)
+            updated = [serializer.instance for serializer in batch]
+            patient_ids += [appointment.patient_id for appointment in updated]
+            for fields, rows in by_fields.items():
+                Appointment.objects.bulk_update(rows, fields)
+            if by_fields:
+                # bulk_update sends no signals
+                transaction.on_commit(lambda: invalidate_history(*patient_ids))
+        return Response(AppointmentSerializer(updated, many=True).data)
 
     @action(detail=True, methods=['post'], url_path='send_reminder', url_name='send_reminder')
     def send_reminder(self, request, pk=None):
@@ -120,8 +285,9 @@ class AppointmentViewSet(viewsets.ModelViewSet):
             reminder_sent=False
         )
         
-        serializer = self.get_serializer(appointments, many=True)
-        return Response(serializer.data)
+        page = self.paginate_queryset(appointments)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
 # ------------------------
 # Logout View
@@ -173,16 +339,75 @@ class LoginView(APIView):
 # ------------------------
 # Queue ViewSet
 # ------------------------
-class QueueViewSet(viewsets.ModelViewSet):
+class QueueViewSet(FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Queue.objects.all()
     serializer_class = QueueSerializer
+    read_serializer = QueueReadSerializer
+    # Today's queue is small and display screens expect the whole list
+    pagination_class = None
+    # Largest batch accepted by bulk_join
+    BULK_JOIN_LIMIT = 200
+
+    def perform_create(self, serializer):
+        # Token numbers always come from the day's sequence
+        serializer.instance = enqueue(
+            serializer.validated_data['patient'],
+            department=serializer.validated_data.get('department'),
+            doctor=serializer.validated_data.get('doctor'),
+        )
+
+    def perform_update(self, serializer):
+        # An entry stays in the queue it was numbered in
+        entry = serializer.save(department=serializer.instance.department, doctor=serializer.instance.doctor)
+        transaction.on_commit(lambda: invalidate_snapshot(entry.scope, entry.queue_date))
+
+    def perform_destroy(self, instance):
+        # A deleted waiting token no longer counts towards anyone's position
+        with transaction.atomic():
+            if instance.status == 'waiting':
+                record_departure(instance)
+            instance.delete()
+            transaction.on_commit(lambda: invalidate_snapshot(instance.scope, instance.queue_date))
+
+    def _requested_scope(self, params):
+        """
+        Queue scope named by optional 'department_id' / 'doctor_id' parameters;
+        the global queue when neither is given.
+        """
+        try:
+            return queue_scope(
+                department_id=params.get('department_id'),
+                doctor_id=params.get('doctor_id'),
+            )
+        except (TypeError, ValueError):
+            raise ParseError({"error": "department_id and doctor_id must be integers."})
+
+    def _requested_queue(self, data):
+        """
+        Department and doctor named by optional 'department_id' / 'doctor_id'
+        fields, as (department, doctor); both None for the global queue.
+        """
+        department = doctor = None
+        try:
+            if data.get('doctor_id'):
+                doctor = doctors.get(data['doctor_id'])
+            elif data.get('department_id'):
+                department = departments.get(data['department_id'])
+        except (TypeError, ValueError):
+            raise ParseError({"error": "department_id and doctor_id must be integers."})
+        except Doctor.DoesNotExist:
+            raise NotFound({"error": "Doctor not found."})
+        except Department.DoesNotExist:
+            raise NotFound({"error": "Department not found."})
+        return department, doctor
 
     # Custom Action 1: Join the Queue (Auto-generate Token)
     @action(detail=False, methods=['post'])
     def join_queue(self, request):
         """
         Allows a patient to join the queue. Automatically assigns the next token number for the day.
-        Expects 'patient_id' in request data.
+        Expects 'patient_id' in request data, plus an optional 'doctor_id' or
+        'department_id' to join that doctor's or department's queue.
         """
         patient_id = request.data.get('patient_id')
         
@@ -195,29 +420,10 @@ class QueueViewSet(viewsets.ModelViewSet):
         except Patient.DoesNotExist:
             return Response({"error": "Patient not found."}, status=status.HTTP_404_NOT_FOUND)
         
-        # Get today's date
-        today = timezone.now().date()
-        today_start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
-        today_end = timezone.make_aware(datetime.combine(today, datetime.max.time()))
-
-        # Find the maximum token number issued today
-        last_token_today = Queue.objects.filter(
-            created_at__range=(today_start, today_end)
-        ).aggregate(Max('token_number'))['token_number__max']
-
-        # Calculate the next token number
-        if last_token_today is None:
-            next_token = 1
-        else:
-            next_token = last_token_today + 1
-
-        # Create the new queue entry
-        queue_entry = Queue.objects.create(
-            patient=patient,
-            token_number=next_token,
-            is_called=False,
-            is_served=False
-        )
+        department, doctor = self._requested_queue(request.data)
+
+        # Take the next number from today's token sequence of that queue
+        queue_entry = enqueue(patient, department=department, doctor=doctor)
 
         serializer = QueueSerializer(queue_entry)
         return Response({
@@ -225,30 +431,61 @@ class QueueViewSet(viewsets.ModelViewSet):
             "token_details": serializer.data
         }, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'])
+    def bulk_join(self, request):
+        """
+        Batch check-in: adds every patient in 'patient_ids' to the same queue
+        (optional 'doctor_id' or 'department_id') with consecutive tokens,
+        in the order given. Nobody is added unless all patients exist.
+        """
+        patient_ids = request.data.get('patient_ids')
+        if not isinstance(patient_ids, list) or not patient_ids:
+            return Response({"error": "patient_ids must be a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(patient_ids) > self.BULK_JOIN_LIMIT:
+            return Response(
+                {"error": f"At most {self.BULK_JOIN_LIMIT} patients can join at once."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            patient_ids = [int(patient_id) for patient_id in patient_ids]
+        except (TypeError, ValueError):
+            return Response({"error": "patient_ids must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One query for the whole batch
+        patients = Patient.objects.in_bulk(patient_ids)
+        missing = [patient_id for patient_id in patient_ids if patient_id not in patients]
+        if missing:
+            return Response(
+                {"error": "Patients not found.", "missing_patient_ids": missing},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        department, doctor = self._requested_queue(request.data)
+
+        entries = enqueue_many(
+            [patients[patient_id] for patient_id in patient_ids], department=department, doctor=doctor
+        )
+
+        serializer = QueueSerializer(entries, many=True)
+        return Response({
+            "message": f"{len(entries)} patients joined the queue.",
+            "tokens": serializer.data
+        }, status=status.HTTP_201_CREATED)
+
     # Custom Action 2: Call the Next Token
     @action(detail=False, methods=['post'])
     def call_next(self, request):
         """
         Admin action: Calls the next token in the queue (the oldest uncalled token).
+        Pass 'doctor_id' or 'department_id' to call from that doctor's or department's queue.
         """
-        # Get today's date
-        today = timezone.now().date()
-        today_start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
-
-        # Find the next token (lowest number, not called, not served, from today)
-        next_in_line = Queue.objects.filter(
-            created_at__gte=today_start,
-            is_called=False,
-            is_served=False
-        ).order_by('token_number').first()
+        # Claim the next token (lowest number, not called, not served, from today).
+        # The claim is atomic, so two counters calling at once get different patients.
+        next_in_line = claim_next(self._requested_scope(request.data))
 
         if not next_in_line:
             return Response({"message": "The queue is empty."}, status=status.HTTP_200_OK)
 
-        # Update the token status to 'called'
-        next_in_line.is_called = True
-        next_in_line.save()
-
         serializer = QueueSerializer(next_in_line)
         return Response({
             "message": "Next token called.",
@@ -270,51 +507,97 @@ class QueueViewSet(viewsets.ModelViewSet):
         if queue_entry.is_served:
             return Response({"message": "Token was already marked as served."}, status=status.HTTP_200_OK)
 
-        queue_entry.is_served = True
-        queue_entry.save()
+        return self._move_token(queue_entry, 'served', "Token successfully marked as served.", "served_token")
+
+    # Custom Action 3b: Skip a Token / Mark it as a No-Show
+    @action(detail=True, methods=['post'])
+    def mark_skipped(self, request, pk=None):
+        """
+        Admin action: Takes a waiting or called token out of the queue without serving it.
+        """
+        return self._move_token(self.get_object(), 'skipped', "Token skipped.", "skipped_token")
+
+    @action(detail=True, methods=['post'])
+    def mark_no_show(self, request, pk=None):
+        """
+        Admin action: Records that the patient did not show up for their token.
+        """
+        return self._move_token(self.get_object(), 'no_show', "Token marked as no-show.", "no_show_token")
+
+    def _move_token(self, queue_entry, new_status, message, key):
+        """Apply a status transition and build the response for it."""
+        if not transition_entry(queue_entry, new_status):
+            queue_entry.refresh_from_db(fields=['status'])
+            return Response(
+                {"error": f"Token is {queue_entry.status} and cannot be marked as {new_status}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         serializer = QueueSerializer(queue_entry)
         return Response({
-            "message": "Token successfully marked as served.",
-            "served_token": serializer.data
+            "message": message,
+            key: serializer.data
         }, status=status.HTTP_200_OK)
 
     # Custom Action 4: Reset the Queue (Daily)
     @action(detail=False, methods=['post'])
     def reset_queue(self, request):
         """
-        ADMIN ONLY: Deletes all queue entries from previous days.
-        This should be called once per day to start fresh.
+        ADMIN ONLY: Moves all queue entries from previous days into the archive.
+        The archive_old_queue_entries task does this every night; this action
+        runs the same batched rollover on demand.
         """
-        # Get today's date
-        today = timezone.now().date()
-        today_start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
-
-        # Delete all queue entries created BEFORE today
-        old_entries = Queue.objects.filter(created_at__lt=today_start)
-        delete_count, _ = old_entries.delete() # Returns (number_deleted, dict_per_model)
+        archived_count = archive_old_entries()
+        publish_queue_event(DEFAULT_SCOPE, 'reset')
 
         return Response({
-            "message": f"Queue reset successfully. Deleted {delete_count} old entries."
+            "message": f"Queue reset successfully. Archived {archived_count} old entries."
         }, status=status.HTTP_200_OK)
 
     # also override the default 'list' to show today's queue by default
     def list(self, request, *args, **kwargs):
         """
         Optionally, you can modify the main GET /api/queues/ to only show today's entries.
+        ?doctor_id= or ?department_id= narrows it to that doctor's or department's queue.
+
+        The result comes from a cached snapshot that is replaced whenever the
+        queue changes, with an ETag so an unchanged queue is answered with 304.
+        Only with a cache shared by all workers, though: with a per-process
+        one, changes made through other workers would not replace it.
         """
         # Get today's date
         today = timezone.now().date()
-        today_start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
 
         # Filter the queryset for today's entries
-        self.queryset = Queue.objects.filter(created_at__gte=today_start)
-        return super().list(request, *args, **kwargs)
+        self.queryset = Queue.objects.filter(queue_date=today)
+        snapshot_scope = ALL_SCOPES
+        if 'doctor_id' in request.query_params or 'department_id' in request.query_params:
+            snapshot_scope = self._requested_scope(request.query_params)
+            self.queryset = self.queryset.filter(scope=snapshot_scope)
+
+        # Searching or ordering needs the full query
+        if set(request.query_params) - {'doctor_id', 'department_id'} or not cache_is_shared():
+            return super().list(request, *args, **kwargs)
+
+        version = snapshot_version(today, snapshot_scope)
+        etag = snapshot_etag(today, snapshot_scope, version)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        client_etags = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in client_etags or '*' in client_etags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        data = get_snapshot(
+            today, snapshot_scope, version,
+            lambda: self.read_serializer.to_representation(
+                self.read_serializer.values(self.filter_queryset(self.get_queryset()))
+            )
+        )
+        return Response(data, headers=headers)
     
     @action(detail=True, methods=['get'])
     def position(self, request, pk=None):
         """
-        Returns the position of this token in today's queue.
+        Returns the position of this token in its queue for today.
         """
         try:
             queue_entry = self.get_object()
@@ -324,21 +607,15 @@ class QueueViewSet(viewsets.ModelViewSet):
         if queue_entry.is_served:
             return Response({"message": "This token has already been served."}, status=status.HTTP_200_OK)
 
-        # Get today's date
-        today = timezone.now().date()
-        today_start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
-
-        # Count how many unserved, uncalled tokens have a smaller token_number
-        ahead = Queue.objects.filter(
-            created_at__gte=today_start,
-            is_called=False,
-            is_served=False,
-            token_number__lt=queue_entry.token_number
-        ).count()
+        # Waiting tokens of the same queue and day with a smaller token_number,
+        # read off the day's watermarks rather than counted
+        ahead = people_ahead(queue_entry)
 
         return Response({
             "token_number": queue_entry.token_number,
             "people_ahead": ahead,
+            # From the queue's rolling average service time; null until it has served someone
+            "estimated_wait_minutes": estimated_wait_minutes(queue_entry, ahead),
         }, status=status.HTTP_200_OK)
     
 
@@ -435,10 +712,11 @@ class ChangePasswordView(APIView):
 # ------------------------
 # Medical Record ViewSet
 # ------------------------
-class MedicalRecordViewSet(viewsets.ModelViewSet):
+class MedicalRecordViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = MedicalRecordSerializer
     permission_classes = [IsAuthenticated]
     queryset = MedicalRecord.objects.all()
+    ordering = ['id']
     
     def get_queryset(self):
         # Patients can only see their own records
@@ -458,6 +736,40 @@ class MedicalRecordViewSet(viewsets.ModelViewSet):
         
         serializer.save()
 
+    def _updated_at(self, queryset):
+        """`updated_at` of the requested record, read on its own, or None."""
+        return queryset.filter(pk=self.kwargs[self.lookup_field]).values_list('updated_at', flat=True).first()
+
+    def retrieve(self, request, *args, **kwargs):
+        variant = representation(request)
+        updated_at = self._updated_at(self.get_queryset())
+        if updated_at is not None and is_not_modified(request, self.kwargs['pk'], updated_at, variant):
+            return Response(
+                status=status.HTTP_304_NOT_MODIFIED, headers=validator_headers(self.kwargs['pk'], updated_at, variant)
+            )
+
+        record = self.get_object()
+        self.headers.update(validator_headers(record.pk, record.updated_at, variant))
+        return Response(self.get_serializer(record).data)
+
+    def update(self, request, *args, **kwargs):
+        with transaction.atomic():
+            # Locked until the update commits, so no other write can slip in
+            # between the If-Match check and this one
+            updated_at = self._updated_at(self.get_queryset().select_for_update())
+            if updated_at is not None and fails_if_match(request, self.kwargs['pk'], updated_at):
+                return Response(
+                    {"error": "The medical record was changed by someone else; reload it and try again."},
+                    status=status.HTTP_412_PRECONDITION_FAILED,
+                    headers=validator_headers(self.kwargs['pk'], updated_at),
+                )
+            return super().update(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        record = serializer.save()
+        # The new validators, for the client's next If-Match
+        self.headers.update(validator_headers(record.pk, record.updated_at))
+
 # ----------------------------
 # Patient Medical RecordView
 # -----------------------------
@@ -472,11 +784,18 @@ class PatientMedicalRecordView(APIView):
                 status=status.HTTP_403_FORBIDDEN
             )
         
+        # Answer an unchanged record from its updated_at alone
+        current = MedicalRecord.objects.filter(patient_id=patient_id).values_list('pk', 'updated_at').first()
+        if current is not None and is_not_modified(request, *current):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=validator_headers(*current))
+
         try:
             patient = Patient.objects.get(id=patient_id)
             medical_record = MedicalRecord.objects.get(patient=patient)
             serializer = MedicalRecordSerializer(medical_record)
-            return Response(serializer.data)
+            return Response(
+                serializer.data, headers=validator_headers(medical_record.pk, medical_record.updated_at)
+            )
         except Patient.DoesNotExist:
             return Response(
                 {"error": "Patient not found"},
@@ -502,16 +821,20 @@ class PatientMedicalHistoryView(APIView):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        try:
-            patient = Patient.objects.get(id=patient_id)
+        def build():
+            # The medical record comes with the patient (its patient_name is
+            # then read from the same row)
+            patient = Patient.objects.select_related('medical_record').get(id=patient_id)
             
-            # Get all related data
+            # Get all related data: one query per list, with the doctor names
+            # the serializers show joined in, so the number of queries stays
+            # the same however long the history is
             appointments = Appointment.objects.filter(patient=patient).order_by('-date')
-            treatments = Treatment.objects.filter(appointment__patient=patient)
+            treatments = Treatment.objects.filter(appointment__patient=patient).select_related('prescribed_by')
             diagnoses = Diagnosis.objects.filter(appointment__patient=patient)
-            notes = MedicalNote.objects.filter(appointment__patient=patient)
+            notes = MedicalNote.objects.filter(appointment__patient=patient).select_related('created_by')
             
-            data = {
+            return {
                 'patient': {
                     'id': patient.id,
                     'name': patient.name,
@@ -525,7 +848,14 @@ class PatientMedicalHistoryView(APIView):
                 'medical_notes': MedicalNoteSerializer(notes, many=True).data,
                 'medical_record': MedicalRecordSerializer(patient.medical_record).data if hasattr(patient, 'medical_record') else None
             }
-            
+
+        try:
+            # Served from the cache until the patient's records change, as
+            # long as every process (web workers, Celery) shares that cache
+            if cache_is_shared():
+                data = get_history(patient_id, history_version(patient_id), build)
+            else:
+                data = build()
             return Response(data)
             
         except Patient.DoesNotExist:
@@ -537,9 +867,12 @@ class PatientMedicalHistoryView(APIView):
 # ----------------------------
 # Treatment ViewSet
 # -----------------------------
-class TreatmentViewSet(viewsets.ModelViewSet):
+class TreatmentViewSet(StreamingExportMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = TreatmentSerializer
+    read_serializer = TreatmentReadSerializer
+    export_name = 'treatments'
     permission_classes = [IsAuthenticated]
+    ordering = ['id']
     
     def get_queryset(self):
         if self.request.user.role in ['doctor', 'staff', 'admin']:
@@ -552,9 +885,12 @@ class TreatmentViewSet(viewsets.ModelViewSet):
 # ----------------------------
 # Diagnosis ViewSet
 # -----------------------------
-class DiagnosisViewSet(viewsets.ModelViewSet):
+class DiagnosisViewSet(StreamingExportMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = DiagnosisSerializer
+    read_serializer = DiagnosisReadSerializer
+    export_name = 'diagnoses'
     permission_classes = [IsAuthenticated]
+    ordering = ['id']
     
     def get_queryset(self):
         if self.request.user.role in ['doctor', 'staff', 'admin']:
@@ -564,9 +900,12 @@ class DiagnosisViewSet(viewsets.ModelViewSet):
 # ----------------------------
 # Medical Note ViewSet
 # -----------------------------
-class MedicalNoteViewSet(viewsets.ModelViewSet):
+class MedicalNoteViewSet(StreamingExportMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = MedicalNoteSerializer
+    read_serializer = MedicalNoteReadSerializer
+    export_name = 'notes'
     permission_classes = [IsAuthenticated]
+    ordering = ['id']
     
     def get_queryset(self):
         if self.request.user.role in ['doctor', 'staff', 'admin']: